@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import tables
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import utilities.utils as utils
+import utilities.root as root
+
+# Settings compared on top of the one in the config file
+CANDIDATES = [
+   {"complib": None},
+   {"complib": "zlib", "complevel": 4, "shuffle": True},
+   {"complib": "blosc:lz4", "complevel": 5, "shuffle": True},
+   {"complib": "blosc:zstd", "complevel": 5, "shuffle": True},
+   {"complib": "blosc:zstd", "complevel": 5, "bitshuffle": True, "shuffle": False},
+]
+CHUNK_ROWS = [None, 256, 4096]
+
+def setting_name(compression, chunk_rows):
+   name = compression.get("complib") or "none"
+   if compression.get("complib"):
+      shuffle = "bitshuffle" if compression.get("bitshuffle") else "shuffle" if compression.get("shuffle", True) else "noshuffle"
+      name += f"-{compression.get('complevel') or 5}-{shuffle}"
+   return f"{name}, chunk_rows={chunk_rows or 'auto'}"
+
+# Same access pattern as h5Dataset: one row of every array per event, random order
+def random_read_rate(h5_path, n_reads, seed=0):
+   with tables.open_file(h5_path, mode="r") as h5file:
+      nodes = [node for node in h5file.walk_nodes("/", classname="Leaf")]
+      n_events = nodes[0].nrows
+      if n_events == 0:
+         return 0.0
+      rows = np.random.default_rng(seed).integers(0, n_events, size=min(n_reads, n_events))
+      start = time.perf_counter()
+      for row in rows:
+         for node in nodes:
+            node[row]
+      return len(rows) / (time.perf_counter() - start)
+
+def benchmark(input_file, tree_name, branches, max_len, settings, n_reads=2000, step_size=None):
+   results = []
+   with tempfile.TemporaryDirectory() as tmp_dir:
+      for i, (compression, chunk_rows) in enumerate(settings):
+         output_file = os.path.join(tmp_dir, f"bench_{i}.h5")
+         start = time.perf_counter()
+         root.root_to_h5(input_file, tree_name, branches, output_file, max_len=max_len,
+                         step_size=step_size, compression=compression, chunk_rows=chunk_rows)
+         convert_time = time.perf_counter() - start
+         results.append({
+            "setting": setting_name(compression, chunk_rows),
+            "size_mb": os.path.getsize(output_file) / 1024**2,
+            "convert_s": convert_time,
+            "reads_per_s": random_read_rate(output_file, n_reads),
+         })
+         os.remove(output_file)
+   return results
+
+def main(config_path, input_file, n_reads):
+   config = utils.load_config(config_path)
+   convertion = utils.require_key(config, 'convertion')
+   tree_name = utils.require_key(convertion, 'tree_name')
+   branches = utils.require_key(convertion, 'branches')
+   max_jagged_len = convertion.get('max_jagged_len') or 10
+   configured = dict(convertion.get('compression') or {})
+   configured_rows = configured.pop('chunk_rows', None)
+
+   settings = [(configured, configured_rows)]
+   settings += [(compression, chunk_rows) for compression in CANDIDATES for chunk_rows in CHUNK_ROWS]
+
+   print(f"Benchmarking {len(settings)} settings on {input_file}")
+   results = benchmark(input_file, tree_name, branches, max_jagged_len, settings, n_reads)
+   print(f"{'setting':<45} {'size [MB]':>10} {'convert [s]':>12} {'reads/s':>10}")
+   for i, r in enumerate(results):
+      label = r["setting"] + (" (config)" if i == 0 else "")
+      print(f"{label:<45} {r['size_mb']:>10.1f} {r['convert_s']:>12.2f} {r['reads_per_s']:>10.0f}")
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Compare HDF5 compression and chunk settings on one ROOT file")
+   parser.add_argument('-f', '--file', type=str, help="Path to the configuration file.", required=True)
+   parser.add_argument('-i', '--input', type=str, help="ROOT file to convert.", required=True)
+   parser.add_argument('-n', '--n-reads', type=int, default=2000, help="Random events read per setting.")
+   args = parser.parse_args()
+
+   main(args.file, args.input, args.n_reads)
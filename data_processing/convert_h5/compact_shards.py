@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import utilities.utils as utils
+import utilities.shards as shards
+
+def main(config_path, dry_run=False):
+
+   config = utils.load_config(config_path)
+   convertion = utils.require_key(config, 'convertion')
+
+   input_dirs = utils.require_key(convertion, 'input_dirs')
+   output_dir = utils.require_key(convertion, 'eos_output_dir')
+   compaction = convertion.get('compaction') or {}
+   target_events = compaction.get('target_events')
+   target_bytes = utils.parse_size(compaction.get('target_bytes'))
+   if not target_events and not target_bytes:
+      raise ValueError("Set compaction target_events or target_bytes")
+   compression = convertion.get('compression') or {}
+
+   for input_dir in input_dirs:
+      exp_dir = os.path.join(output_dir, os.path.basename(os.path.normpath(input_dir)))
+      if not os.path.isdir(exp_dir):
+         print(f"Skipping {exp_dir}: not converted yet")
+         continue
+      shards.compact_directory(exp_dir, target_events, target_bytes, compression, compression.get('chunk_rows'),
+                               dry_run=dry_run)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Merge the converted h5 files of each experiment into shards")
+   parser.add_argument('-f', '--file', type=str, help="Path to the configuration file.", required=True)
+   parser.add_argument('--dry-run', action='store_true', help="Only report the planned shards, do not write them.")
+   args = parser.parse_args()
+
+   main(args.file, dry_run=args.dry_run)
@@ -7,12 +7,42 @@ sys.path.insert(0, parent_dir)
 import utilities.utils as utils
 import utilities.lxplus as lxplus
 import utilities.root as root
+import utilities.catalogue as catalogue
+import utilities.planner as planner
+import utilities.executor as executor
 
-def main(config_path):
+# Bytes of ROOT data read per chunk. Padding jagged branches and the awkward -> numpy
+# copies take several times the chunk size, so by default use 1/8 of the job memory,
+# shared between the files converted in parallel.
+MEM_PER_CHUNK = 8
+
+def conversion_step_size(chunk_size, mem, n_workers=1):
+   if chunk_size:
+      step_bytes = utils.parse_size(chunk_size)
+   elif mem:
+      step_bytes = utils.parse_size(mem) // MEM_PER_CHUNK // n_workers
+   else:
+      return None
+   return f"{max(1, step_bytes // 1024**2)} MB"
+
+# Branches used by the training config: its features and label. Features that are
+# derived columns are computed during the conversion instead.
+def training_branches(training_config_path, derived):
+   data_config = utils.require_key(utils.load_config(training_config_path), 'data')
+   features = utils.require_key(data_config, 'features')
+   label = utils.require_key(data_config, 'label')
+   if features == "all" or features == ["all"]:
+      return "all"
+   return [f for f in features if f not in derived] + [label]
+
+def main(config_path, dry_run=False, suggest_max_len=False):
    
    config = utils.load_config(config_path)
    convertion = utils.require_key(config, 'convertion')
    condor_params = utils.require_key(config, 'condor_params')
+   proxy_path = (config.get('proxy') or {}).get('proxy_path')
+   if proxy_path:
+      proxy_path = lxplus.expand_proxy_path(proxy_path)
    
    input_dirs = utils.require_key(convertion, 'input_dirs')
    tree_name = utils.require_key(convertion,'tree_name')
@@ -21,34 +51,116 @@ def main(config_path):
    max_jagged_len = utils.require_key(convertion, 'max_jagged_len')
    if not max_jagged_len:
       max_jagged_len = 10
+   catalogue_path = convertion.get('catalogue_path')
+   job_planning = convertion.get('job_planning') or {}
+   executor_name = convertion.get('executor') or "condor"
+   target_events = job_planning.get('target_events')
+   target_bytes = utils.parse_size(job_planning.get('target_bytes'))
+   n_cpus = int(condor_params.get('cpus') or 1)
+   n_workers = int(convertion.get('workers') or n_cpus)
+   step_size = conversion_step_size(convertion.get('chunk_size'), condor_params.get('mem'), n_workers)
+   compression = convertion.get('compression') or {}
+   chunk_rows = compression.get('chunk_rows')
+   layout = convertion.get('layout') or "columns"
+   label = convertion.get('label')
+   if layout not in ("columns", "matrix"):
+      raise ValueError(f"Unknown layout '{layout}', use 'columns' or 'matrix'")
+   derived = convertion.get('derived_columns') or {}
+   training_config = convertion.get('training_config')
+   if training_config:
+      branches = training_branches(training_config, derived)
+      print(f"Branches from {training_config}: {branches}")
+   if layout == "matrix" and not label:
+      # h5Dataset reads the label as its own array, it must not end up in the matrix
+      if not training_config:
+         raise ValueError("layout 'matrix' needs a label, set 'label' or 'training_config'")
+      label = utils.require_key(utils.require_key(utils.load_config(training_config), 'data'), 'label')
+   output_format = convertion.get('output_format') or "h5"
+   output_suffix = {"h5": ".h5", "npy": root.NPY_SUFFIX}.get(output_format)
+   if output_suffix is None:
+      raise ValueError(f"Unknown output_format '{output_format}', use 'h5' or 'npy'")
+   append = bool(convertion.get('append'))
+   if append and output_format != "h5":
+      raise ValueError("append is only available with output_format 'h5'")
+   jagged = convertion.get('jagged_storage') or "pad"
+   if jagged not in ("pad", "ragged"):
+      raise ValueError(f"Unknown jagged_storage '{jagged}', use 'pad' or 'ragged'")
+
+   if suggest_max_len:
+      input_paths = [path for input_dir in input_dirs for path in catalogue.list_root_files(input_dir)]
+      print(f"Scanning jagged branch multiplicities in {len(input_paths)} files")
+      histograms = root.multiplicity_histograms(input_paths, tree_name, branches)
+      root.report_max_len(histograms, convertion.get('max_len_percentile') or 99.9, max_jagged_len)
+      return
       
    if not os.path.exists(output_dir):
       os.makedirs(output_dir)
       
    args_dat = []
+   all_jobs = []
    for input_dir in input_dirs:
       exp_name = os.path.basename(os.path.normpath(input_dir))
       exp_dir = os.path.join(output_dir, exp_name)
-      os.makedirs(exp_dir, exist_ok=True)
+      if not dry_run:
+         os.makedirs(exp_dir, exist_ok=True)
       
-      root_files = [f for f in os.listdir(input_dir) if f.endswith('.root')]
-      for root_file in root_files:
-         input_path = os.path.join(input_dir, root_file)
-         output_path = os.path.join(exp_dir, os.path.splitext(root_file)[0] + '.h5')
-         args_dat.append(f"{input_path} {output_path}")
+      input_paths = catalogue.list_root_files(input_dir)
+      # Files are only opened for a persisted catalogue, or when their entries or
+      # branches are needed; otherwise os.stat gives the sizes
+      if catalogue_path or target_events or (append and branches in ("all", ["all"])):
+         metadata = catalogue.build_catalogue(input_paths, catalogue_path, tree_name)
+      else:
+         metadata = {path: {"entries": None, "size": os.path.getsize(path)} for path in input_paths}
+      files = []
+      n_complete = 0
+      for input_path in input_paths:
+         if metadata[input_path]["entries"] == 0:
+            print(f"Skipping {input_path}: empty '{tree_name}' tree")
+            continue
+         root_file = os.path.basename(input_path)
+         output_path = os.path.join(exp_dir, os.path.splitext(root_file)[0] + output_suffix)
+         if append:
+            requested = list(metadata[input_path]["branches"]) if branches in ("all", ["all"]) else list(branches)
+            if not root.missing_columns(output_path, requested + list(derived)):
+               n_complete += 1
+               continue
+         files.append({
+            "path": input_path,
+            "output": output_path,
+            "entries": metadata[input_path]["entries"],
+            "bytes": metadata[input_path]["size"],
+         })
+
+      if append:
+         print(f"{exp_name}: {n_complete} outputs already have every branch, {len(files)} to convert or extend")
+      jobs = planner.plan_jobs(files, target_events, target_bytes)
+      all_jobs.extend(jobs)
+      for job in jobs:
+         outputs = planner.JOB_LIST_SEP.join(f["output"] for f in job)
+         args_dat.append(f"{planner.job_paths(job)} {outputs}")
 
+   planner.report(all_jobs)
+   print(f"Reading {step_size or 'whole trees'} per chunk, up to {n_workers} files in parallel per job")
+   if dry_run:
+      return
 
    utils.write_args_file("args_conversion.dat", args_dat)
 
-   lxplus.set_env_vars_conversion(tree_name, branches, max_jagged_len)
+   lxplus.set_env_vars_conversion(tree_name, branches, max_jagged_len, step_size, compression, chunk_rows,
+                                  layout, label, n_workers, n_cpus, jagged, derived,
+                                  output_format, append, proxy_path)
 
-   condor_file = lxplus.create_condor_convert_file(condor_params)
-   
-   utils.submit_condor(condor_file)
+   # Local jobs get the same input files that condor transfers
+   job_executor = executor.get_executor(executor_name, condor_params, lxplus.create_condor_convert_file,
+                                        transfer_input_files=["conversion_container.sif", parent_dir + "/utilities",
+                                                              os.path.dirname(parent_dir) + "/shared"])
+   job_executor.run("args_conversion.dat")
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert NanoAOD root file to h5 file")
     parser.add_argument('-f', '--file', type=str, help="Path to the configuration file.", required=True)
+    parser.add_argument('--dry-run', action='store_true', help="Only report the planned jobs, do not submit.")
+    parser.add_argument('--suggest-max-len', action='store_true', help="Scan the jagged branches and suggest max_jagged_len, do not submit.")
     args = parser.parse_args()
     
-    main(args.file)
+    main(args.file, dry_run=args.dry_run, suggest_max_len=args.suggest_max_len)
@@ -3,19 +3,37 @@
 echo "Starting job on $(date)"
 echo "Running on: $(hostname)"
 
+# ";"-separated lists, one output per input
 INPUT_FILE=$1
 OUTPUT_FILE=$2
 
 apptainer exec --bind /eos conversion_container.sif python3 - <<EOF
+import os
+import json
 import utilities.root as root
 
-input_path = "$INPUT_FILE"
-output_path = "$OUTPUT_FILE"
+input_paths = "$INPUT_FILE".split(";")
+output_paths = "$OUTPUT_FILE".split(";")
 tree = "$TREE_NAME"
 branches = "$BRANCHES".split(",")
 max_jagged_len = int("$MAX_JAGGED_LEN")
+step_size = "$STEP_SIZE" or None
+# JSON values are read from the environment, quotes in them would break this script
+compression = json.loads(os.environ.get("H5_COMPRESSION") or "{}")
+chunk_rows = int("$H5_CHUNK_ROWS") if "$H5_CHUNK_ROWS" else None
+layout = "$H5_LAYOUT" or "columns"
+label = "$H5_LABEL" or None
+n_workers = int("${CONVERSION_WORKERS:-1}")
+n_cpus = int("${CONVERSION_CPUS:-1}")
+jagged = "${H5_JAGGED:-pad}"
+derived = json.loads(os.environ.get("DERIVED_COLUMNS") or "{}")
+output_format = "${OUTPUT_FORMAT:-h5}"
+append = bool("$H5_APPEND")
 
-root.root_to_h5(input_path, tree, branches, output_path, max_len=max_jagged_len)
+root.convert_files(input_paths, output_paths, tree, branches, n_workers=n_workers, n_cpus=n_cpus,
+                   max_len=max_jagged_len, step_size=step_size, compression=compression,
+                   chunk_rows=chunk_rows, layout=layout, label=label, jagged=jagged,
+                   derived=derived, output_format=output_format, append=append)
 EOF
 
 echo "Time $(date)"
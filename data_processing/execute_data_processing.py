@@ -2,8 +2,12 @@ import argparse
 import os
 import utilities.utils as utils
 import utilities.lxplus as lxplus
+import utilities.catalogue as catalogue
+import utilities.planner as planner
+import utilities.manifest as manifest
+import utilities.executor as executor
 
-def main(config_path):
+def main(config_path, dry_run=False, status_only=False):
 
     config = utils.load_config(config_path)
     proxy_config = utils.require_key(config, 'proxy')
@@ -15,46 +19,100 @@ def main(config_path):
     afs_cms_base = utils.require_key(processing_config, 'afs_cms_base')
     condor_params = utils.require_key(processing_config, 'condor_params')
     processing_script = utils.require_key(processing_config, 'processing_script')
+    processing_mode = processing_config.get('processing_mode') or "event"
+    output_mode = processing_config.get('output_mode') or "full"
+    # Shared with the worker nodes, so it should live on EOS
+    catalogue_path = processing_config.get('catalogue_path')
+    job_planning = processing_config.get('job_planning') or {}
+    executor_name = processing_config.get('executor') or "condor"
+    target_events = job_planning.get('target_events')
+    target_bytes = utils.parse_size(job_planning.get('target_bytes'))
     
-    if gen_proxy == 1:
+    if gen_proxy == 1 and not (dry_run or status_only):
        lxplus.generate_proxy(proxy_config)
 
     proxy_path = utils.require_key(proxy_config, 'proxy_path')
     proxy_path = lxplus.expand_proxy_path(proxy_path)
 
-    lxplus.set_env_vars_processing(proxy_path, eos_output_dir, afs_cms_base, processing_script)
+    lxplus.set_env_vars_processing(proxy_path, eos_output_dir, afs_cms_base, processing_script, processing_mode, output_mode, catalogue_path)
     
-    datasets = lxplus.das_query_endpoints(redirector, datasets)
+    datasets = lxplus.das_query_endpoints(redirector, datasets, processing_config.get('das'))
+
+    if catalogue_path:
+       endpoints = [endpoint for dataset in datasets for endpoint in dataset["endpoints"]]
+       metadata = catalogue.build_catalogue(endpoints, catalogue_path)
+       for dataset in datasets:
+          for file_info in dataset["files"]:
+             meta = metadata[file_info["path"]]
+             file_info["entries"] = meta["entries"]
+             file_info["bytes"] = meta["compressed_bytes"]
+             file_info["is_data"] = meta["is_data"]
+
+    # Only endpoints whose output is missing, truncated or made by another script/config are resubmitted
+    dataset_dirs = {dataset["LFN"]: f"{eos_output_dir}/{utils.path_to_dir_name(dataset['LFN'])}" for dataset in datasets}
+    manifest_path = os.path.join(eos_output_dir, manifest.MANIFEST_NAME)
+    processing_manifest = manifest.load_manifest(manifest_path)
+    source = manifest.source_hash(os.path.join(afs_cms_base, processing_script))
+    fingerprints = {dataset["LFN"]: manifest.fingerprint(source, {"processing_mode": processing_mode, "output_mode": output_mode,
+                                                                  "LFN": dataset["LFN"], "ID": dataset["ID"]})
+                    for dataset in datasets}
+    statuses = manifest.check_outputs(processing_manifest, datasets, dataset_dirs, fingerprints, output_mode)
+    manifest.print_status(statuses)
+    if status_only:
+       if os.path.isdir(eos_output_dir):
+          manifest.save_manifest(manifest_path, processing_manifest)
+       return
         
     args_dat = []
+    all_jobs = []
+    submitted = []
     mapping = {}
     for dataset in datasets:
        LFN = dataset["LFN"]
        ID = dataset["ID"]
-       endpoints = dataset["endpoints"]
-       dataset_dir = f"{eos_output_dir}/{utils.path_to_dir_name(LFN)}"
-       
-       os.makedirs(dataset_dir, exist_ok=True)
+       dataset_dir = dataset_dirs[LFN]
+       by_status = statuses[LFN]
+       pending_paths = {f["path"] for status in ("missing", "truncated", "stale") for f in by_status[status]}
+       pending = [f for f in dataset["files"] if f["path"] in pending_paths]
 
-       for i, endpoint in enumerate(endpoints, 1):
-          args_dat.append(f"{endpoint}, {LFN}, {dataset_dir}")
+       jobs = planner.plan_jobs(pending, target_events, target_bytes)
+       all_jobs.extend(jobs)
+       submitted.append((pending, fingerprints[LFN]))
+       for job in jobs:
+          args_dat.append(f"{planner.job_paths(job)}, {LFN}, {dataset_dir}")
 
        mapping[ID] = LFN
 
+    planner.report(all_jobs)
+    if dry_run:
+       return
+
+    if not args_dat:
+       print("All outputs are up to date, nothing to submit.")
+       return
+
+    for dataset_dir in dataset_dirs.values():
+       os.makedirs(dataset_dir, exist_ok=True)
+
     utils.write_args_file("args_processing.dat", args_dat)
 
+    for files, dataset_fingerprint in submitted:
+       manifest.mark_submitted(processing_manifest, files, dataset_fingerprint)
+    manifest.save_manifest(manifest_path, processing_manifest)
+
     utils.write_map_file("mapping.json", mapping)
 
     utils.exe_cmd(['bash', 'set_env.sh'], allow_tty_mode=True)
 
-    name_file = lxplus.create_condor_processing_file(condor_params)
-    
-    utils.submit_condor(name_file)
+    job_executor = executor.get_executor(executor_name, condor_params, lxplus.create_condor_processing_file)
+    job_executor.run("args_processing.dat")
        
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser(description="Processing NanoAOD root files")
    parser.add_argument('-f', '--file', type=str, help="Path to the configuration file.", required=True)
+   parser.add_argument('--dry-run', action='store_true', help="Only report the planned jobs, do not submit.")
+   parser.add_argument('--status', action='store_true', help="Summarize how much of each dataset is done, do not submit.")
    args = parser.parse_args()
    
-   main(args.file)
+   main(args.file, dry_run=args.dry_run, status_only=args.status)
@@ -3,6 +3,7 @@
 echo "Starting job on $(date)"
 echo "Running on: $(hostname)"
 
+# ";"-separated list of input files processed by this job
 INPUT_FILE=$1
 LFN=$2
 OUTPUT_DIR=$3
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The repository root holds the `shared` package used by both data_processing and
+# ml_training. Jobs get a copy of `shared` next to `utilities`, already on the path.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if os.path.isdir(os.path.join(ROOT_DIR, "shared")) and ROOT_DIR not in sys.path:
+   sys.path.append(ROOT_DIR)
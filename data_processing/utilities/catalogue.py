@@ -0,0 +1,33 @@
+import os
+import uproot
+import shared.file_index as file_index
+
+# Local index of ROOT file metadata shared by processing, conversion and job planning,
+# kept up to date as described in shared/file_index.py.
+
+def scan_file(path, tree_name="Events"):
+   with uproot.open(path) as upfile:
+      tree = upfile[tree_name]
+      branch_names = tree.keys()
+      return {
+         "tree": tree_name,
+         "entries": int(tree.num_entries),
+         "branches": {name: tree[name].typename for name in branch_names},
+         "is_data": "genWeight" not in branch_names,
+         "compressed_bytes": int(tree.member("fZipBytes")),
+         "uncompressed_bytes": int(tree.member("fTotBytes")),
+         "clusters": [int(x) for x in tree.common_entry_offsets()],
+      }
+
+# Scan only new or changed files, in parallel, and return the entries of `paths`
+def build_catalogue(paths, index_path, tree_name="Events", max_workers=8):
+   catalogue = file_index.load_index(index_path)
+   stale = file_index.update_index(catalogue, paths, lambda p: scan_file(p, tree_name), max_workers)
+   if stale and index_path:
+      file_index.save_index(index_path, catalogue)
+
+   print(f"Catalogue: {len(paths) - len(stale)} files reused, {len(stale)} scanned")
+   return {path: catalogue[path] for path in paths}
+
+def list_root_files(input_dir):
+   return [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir)) if f.endswith('.root')]
@@ -0,0 +1,91 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import utilities.utils as utils
+
+# Executors run the jobs listed in an args_*.dat file, either through HTCondor
+# or on the local node. Both read the same condor_params and the same env
+# variables (set by lxplus.set_env_vars_*), so the job scripts do not change.
+
+MAX_ATTEMPTS = 5  # runs of a failing job before it is reported as failed
+
+def read_args_file(args_file):
+   with open(args_file) as f:
+      # Same splitting as condor `queue ... from`: commas and/or whitespace
+      return [re.split(r"[,\s]+", line.strip()) for line in f if line.strip()]
+
+def total_memory():
+   return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+class CondorExecutor:
+   def __init__(self, condor_params, create_condor_file):
+      self.condor_params = condor_params
+      self.create_condor_file = create_condor_file
+
+   def run(self, args_file):
+      name_file = self.create_condor_file(self.condor_params)
+      utils.submit_condor(name_file)
+
+
+def _run_local_job(job_id, executable, args, work_dir, logs_dir, transfer_input_files, max_attempts):
+   os.makedirs(work_dir, exist_ok=True)
+   for path in transfer_input_files:
+      link = os.path.join(work_dir, os.path.basename(os.path.normpath(path)))
+      if not os.path.exists(link):
+         os.symlink(os.path.abspath(path), link)
+
+   cmd = ["bash", executable, *args] if executable.endswith(".sh") else [executable, *args]
+   for attempt in range(max_attempts):
+      log_name = os.path.join(logs_dir, f"job_local_{job_id}")
+      with open(f"{log_name}.out", "a") as out, open(f"{log_name}.err", "a") as err:
+         out.write(f"=== attempt {attempt + 1}: {' '.join(cmd)}\n")
+         out.flush()
+         returncode = subprocess.run(cmd, cwd=work_dir, stdout=out, stderr=err).returncode
+      if returncode == 0:
+         return job_id, returncode, attempt + 1
+   return job_id, returncode, max_attempts
+
+class LocalExecutor:
+   def __init__(self, condor_params, logs_dir="logs", work_dir="local_jobs", transfer_input_files=(), max_attempts=MAX_ATTEMPTS):
+      self.executable = os.path.abspath(utils.require_key(condor_params, "executable_file"))
+      self.logs_dir = os.path.abspath(logs_dir)
+      self.work_dir = os.path.abspath(work_dir)
+      self.transfer_input_files = list(transfer_input_files)
+      self.max_attempts = max_attempts
+
+      # As many jobs as fit in the node with the cpus/mem requested per job
+      cpus = int(condor_params.get("cpus") or 1)
+      mem = utils.parse_size(utils.require_key(condor_params, "mem"))
+      n_workers = max(1, (os.cpu_count() or 1) // cpus)
+      if mem:
+         n_workers = max(1, min(n_workers, total_memory() // mem))
+      self.max_workers = n_workers
+
+   def run(self, args_file):
+      jobs = read_args_file(args_file)
+      os.makedirs(self.logs_dir, exist_ok=True)
+      print(f"Running {len(jobs)} jobs locally with {self.max_workers} workers, logs in {self.logs_dir}")
+
+      failed = []
+      with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+         futures = [pool.submit(_run_local_job, job_id, self.executable, args,
+                                os.path.join(self.work_dir, f"job_{job_id}"), self.logs_dir,
+                                self.transfer_input_files, self.max_attempts)
+                    for job_id, args in enumerate(jobs)]
+         for future in as_completed(futures):
+            job_id, returncode, attempts = future.result()
+            status = "done" if returncode == 0 else f"FAILED (exit code {returncode})"
+            print(f"Job {job_id} {status} after {attempts} attempt(s)")
+            if returncode != 0:
+               failed.append(job_id)
+
+      print(f"{len(jobs) - len(failed)}/{len(jobs)} jobs succeeded")
+      return failed
+
+def get_executor(name, condor_params, create_condor_file, transfer_input_files=()):
+   if name in (None, "condor"):
+      return CondorExecutor(condor_params, create_condor_file)
+   if name == "local":
+      return LocalExecutor(condor_params, transfer_input_files=transfer_input_files)
+   raise ValueError(f"Unknown executor '{name}', use 'condor' or 'local'")
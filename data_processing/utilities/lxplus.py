@@ -1,5 +1,8 @@
 import os
 import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import utilities.utils as utils
 
 def expand_proxy_path(path):
@@ -24,37 +27,120 @@ def generate_proxy(proxy_config):
    print(f'\nTo set env varible in current shell execute: export X509_USER_PROXY={proxy_path}')
 
    
-def das_query_endpoints(redirector, datasets): 
+def das_cache_path(cache_dir, LFN):
+   return os.path.join(cache_dir, f"{utils.path_to_dir_name(LFN)}.json")
+
+# A cached file list is reused if it is younger than the TTL and holds at least `amount` files
+def read_das_cache(cache_dir, LFN, amount, ttl):
+   if not cache_dir:
+      return None
+   path = das_cache_path(cache_dir, LFN)
+   if not os.path.exists(path):
+      return None
+   with open(path) as f:
+      entry = json.load(f)
+   age = time.time() - entry["time"]
+   if age > ttl:
+      return None
+   if entry["amount"] != -1 and (amount == -1 or entry["amount"] < amount):
+      return None
+   print(f"DAS cache: reusing {LFN} ({len(entry['lines'])} files, {age / 3600:.1f} h old)")
+   return entry["lines"]
+
+def write_das_cache(cache_dir, LFN, amount, lines):
+   if not cache_dir:
+      return
+   os.makedirs(cache_dir, exist_ok=True)
+   path = das_cache_path(cache_dir, LFN)
+   with open(f"{path}.tmp", "w") as f:
+      json.dump({"time": time.time(), "amount": amount, "lines": lines}, f)
+   os.replace(f"{path}.tmp", path)
+
+def das_query_files(LFN, amount, das_client='dasgoclient', cache_dir=None, ttl=86400):
+   lines = read_das_cache(cache_dir, LFN, amount, ttl)
+   if lines is None:
+      cmd = [das_client, '-query', f'file dataset={LFN} | grep file.name, file.size, file.nevents']
+      if amount != -1:
+         cmd += ['-limit', str(amount)]
+      output = utils.exe_cmd(cmd)
+      if output is None:
+         raise RuntimeError(f"DAS query failed for dataset {LFN}")
+      lines = [line for line in output.splitlines() if line.strip()]
+      write_das_cache(cache_dir, LFN, amount, lines)
+   return lines if amount == -1 else lines[:amount]
+
+# Queries run concurrently, das_config may set client, max_workers, cache_dir and cache_ttl_hours
+def das_query_endpoints(redirector, datasets, das_config=None): 
+   das_config = das_config or {}
+   das_client = das_config.get('client') or 'dasgoclient'
+   max_workers = das_config.get('max_workers') or 8
+   cache_dir = das_config.get('cache_dir')
+   ttl = float(das_config.get('cache_ttl_hours') or 24) * 3600
+
    for dataset in datasets:
-      LFN = utils.require_key(dataset, 'LFN')
-      ID = utils.require_key(dataset, 'ID')
-      amount = utils.require_key(dataset, 'amount')
-
-      cmd = ['dasgoclient', '-query', f'file dataset={LFN}']
-
-      if amount == -1:
-         files = utils.exe_cmd(cmd).splitlines()
-      else:
-         files = utils.exe_cmd(cmd).splitlines()[:amount]
-      
-      endpoints = [f"root://{redirector}/{f}" for f in files]
-      dataset['endpoints'] = endpoints
+      utils.require_key(dataset, 'LFN')
+      utils.require_key(dataset, 'ID')
+      utils.require_key(dataset, 'amount')
+
+   def query(dataset):
+      return das_query_files(dataset['LFN'], dataset['amount'], das_client, cache_dir, ttl)
+
+   with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      all_lines = list(pool.map(query, datasets))
+
+   for dataset, lines in zip(datasets, all_lines):
+      is_data = is_data_dataset(dataset['LFN'])
+      files = [parse_das_file_line(line, redirector, is_data) for line in lines]
+      dataset['files'] = files
+      dataset['endpoints'] = [f["path"] for f in files]
    return datasets
 
+# Simulation has a *SIM data tier (e.g. NANOAODSIM), collision data does not (NANOAOD)
+def is_data_dataset(LFN):
+   return not LFN.rstrip("/").split("/")[-1].endswith("SIM")
+
+# "<name> <size> <nevents>" as returned by the grep query above
+def parse_das_file_line(line, redirector, is_data=None):
+   fields = line.split()
+   file_info = {"path": f"root://{redirector}/{fields[0]}", "bytes": None, "entries": None, "is_data": is_data}
+   if len(fields) >= 3:
+      file_info["bytes"] = int(fields[1])
+      file_info["entries"] = int(fields[2])
+   return file_info
+
 
 # This function sets env variables that will be transferred to
 # worker nodes using `getenv` in the condor file.
 # This reduces the number of arguments for the executable file.
-def set_env_vars_processing(proxy_path, eos_output_dir, afs_cms_base, processing_script):
+def set_env_vars_processing(proxy_path, eos_output_dir, afs_cms_base, processing_script, processing_mode="event", output_mode="full", catalogue_path=None):
    os.environ['X509_USER_PROXY'] = proxy_path
    os.environ['EOS_OUTPUT_DIR'] = eos_output_dir
    os.environ['AFS_CMS_BASE'] = afs_cms_base
    os.environ['PROCESSING_SCRIPT'] = processing_script
+   os.environ['PROCESSING_MODE'] = processing_mode
+   os.environ['OUTPUT_MODE'] = output_mode
+   os.environ['ROOT_CATALOGUE'] = catalogue_path or ""
    
-def set_env_vars_conversion(tree_name, branches, max_jagged_len):
+def set_env_vars_conversion(tree_name, branches, max_jagged_len, step_size="", compression=None, chunk_rows=None, layout="columns", label=None,
+                            n_workers=1, n_cpus=1, jagged="pad", derived=None,
+                            output_format="h5", append=False, proxy_path=None):
    os.environ['TREE_NAME'] = tree_name
    os.environ['BRANCHES'] = ",".join(branches) if isinstance(branches, list) else str(branches)
    os.environ['MAX_JAGGED_LEN'] = str(max_jagged_len)
+   os.environ['STEP_SIZE'] = step_size or ""
+   os.environ['H5_COMPRESSION'] = json.dumps(compression or {})
+   os.environ['H5_CHUNK_ROWS'] = str(chunk_rows or "")
+   os.environ['H5_LAYOUT'] = layout or "columns"
+   os.environ['H5_LABEL'] = label or ""
+   os.environ['CONVERSION_WORKERS'] = str(n_workers)
+   os.environ['CONVERSION_CPUS'] = str(n_cpus)
+   os.environ['H5_JAGGED'] = jagged
+   os.environ['DERIVED_COLUMNS'] = json.dumps(derived or {})
+   os.environ['OUTPUT_FORMAT'] = output_format
+   os.environ['H5_APPEND'] = "1" if append else ""
+   # Friend files are joined with their root:// source files, read with the grid proxy
+   if proxy_path:
+      os.environ['X509_USER_PROXY'] = proxy_path
 
 def create_condor_processing_file(condor_params):
    name_file = "processing.jdl"
@@ -66,7 +152,7 @@ def create_condor_processing_file(condor_params):
       f.write(f"""universe = vanilla
 executable = {exe}
 arguments = "$(INPUT_FILE) $(LFN) $(OUTPUT_DIR)"
-getenv = X509_USER_PROXY, EOS_OUTPUT_DIR, AFS_CMS_BASE, PROCESSING_SCRIPT
+getenv = X509_USER_PROXY, EOS_OUTPUT_DIR, AFS_CMS_BASE, PROCESSING_SCRIPT, PROCESSING_MODE, OUTPUT_MODE, ROOT_CATALOGUE
 output = logs/job_$(ClusterId)_$(ProcId).out
 error = logs/job_$(ClusterId)_$(ProcId).err
 log = logs/job_$(ClusterId)_$(ProcId).log
@@ -91,8 +177,8 @@ def create_condor_convert_file(condor_params):
       f.write(f"""universe = vanilla
 executable = {exe}
 arguments = "$(INPUT_FILE) $(OUTPUT_FILE)"
-getenv = TREE_NAME, BRANCHES, MAX_JAGGED_LEN
-transfer_input_files = conversion_container.sif, ../utilities
+getenv = X509_USER_PROXY, TREE_NAME, BRANCHES, MAX_JAGGED_LEN, STEP_SIZE, H5_COMPRESSION, H5_CHUNK_ROWS, H5_LAYOUT, H5_LABEL, CONVERSION_WORKERS, CONVERSION_CPUS, H5_JAGGED, DERIVED_COLUMNS, OUTPUT_FORMAT, H5_APPEND
+transfer_input_files = conversion_container.sif, ../utilities, ../../shared
 output = logs/job_$(ClusterId)_$(ProcId).out
 error = logs/job_$(ClusterId)_$(ProcId).err
 log = logs/job_$(ClusterId)_$(ProcId).log
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import hashlib
+import uproot
+
+# Processing manifest: per endpoint, the expected output file, what was found
+# there and the fingerprint of the code+settings that produced it. Reruns use
+# it to submit only endpoints whose output is missing, truncated or stale.
+
+MANIFEST_NAME = "processing_manifest.json"
+OUTPUT_POSTFIX = {"full": "_Skim", "friend": "_Friend"}
+
+# Hash of the processing script and of the Python modules next to it, which it imports
+def source_hash(script_path):
+   digest = hashlib.sha256()
+   if not script_path or not os.path.exists(script_path):
+      digest.update(str(script_path).encode())
+      return digest.hexdigest()
+   script_dir = os.path.dirname(os.path.abspath(script_path))
+   for name in sorted(f for f in os.listdir(script_dir) if f.endswith(".py")):
+      digest.update(name.encode())
+      with open(os.path.join(script_dir, name), "rb") as f:
+         digest.update(f.read())
+   return digest.hexdigest()
+
+# One per dataset, so adding or removing a dataset leaves the others up to date
+def fingerprint(source, settings):
+   digest = hashlib.sha256(source.encode())
+   digest.update(json.dumps(settings, sort_keys=True).encode())
+   return digest.hexdigest()[:16]
+
+def expected_output(endpoint, dataset_dir, output_mode="full"):
+   base_name = os.path.splitext(os.path.basename(endpoint))[0]
+   return os.path.join(dataset_dir, f"{base_name}{OUTPUT_POSTFIX[output_mode]}.root")
+
+def load_manifest(path):
+   if not os.path.exists(path):
+      return {}
+   with open(path) as f:
+      return json.load(f)
+
+def save_manifest(path, manifest):
+   with open(f"{path}.tmp", "w") as f:
+      json.dump(manifest, f, indent=1)
+   os.replace(f"{path}.tmp", path)
+
+def output_entries(path, tree_name="Events"):
+   try:
+      with uproot.open(path) as upfile:
+         return int(upfile[tree_name].num_entries)
+   except Exception:
+      return None
+
+# One of "done", "missing", "truncated" or "stale"
+def endpoint_status(entry, output_path, current_fingerprint, file_info):
+   if not os.path.exists(output_path):
+      return "missing"
+   st = os.stat(output_path)
+   # Only an output written after the last submission was made with the submitted fingerprint
+   submitted_time = entry.get("submitted_time")
+   rewritten = submitted_time is not None and st.st_mtime > submitted_time
+   produced_by = entry.get("submitted_fingerprint") if rewritten else entry.get("fingerprint")
+   if produced_by not in (None, current_fingerprint):
+      return "stale"
+
+   verified = (entry.get("output_bytes") == st.st_size and entry.get("output_mtime") == st.st_mtime
+               and entry.get("output_entries") is not None)
+   if not verified:
+      n_entries = output_entries(output_path)
+      if n_entries is None:
+         return "truncated"
+      entry.update(output_bytes=st.st_size, output_mtime=st.st_mtime, output_entries=n_entries)
+
+   # MC keeps every event, data may lose some to the golden JSON
+   input_entries = file_info.get("entries")
+   if file_info.get("is_data") is False and input_entries is not None and entry["output_entries"] != input_entries:
+      return "truncated"
+   if rewritten:
+      entry["fingerprint"] = entry.pop("submitted_fingerprint")
+      entry.pop("submitted_time")
+   return "done"
+
+# Updates `manifest` in place and returns {LFN: {status: [file_info, ...]}}
+def check_outputs(manifest, datasets, dataset_dirs, fingerprints, output_mode="full"):
+   statuses = {}
+   for dataset in datasets:
+      LFN = dataset["LFN"]
+      current_fingerprint = fingerprints[LFN]
+      by_status = statuses.setdefault(LFN, {"done": [], "missing": [], "truncated": [], "stale": []})
+      for file_info in dataset["files"]:
+         endpoint = file_info["path"]
+         output_path = expected_output(endpoint, dataset_dirs[LFN], output_mode)
+         entry = manifest.setdefault(endpoint, {"output": output_path})
+         status = endpoint_status(entry, output_path, current_fingerprint, file_info)
+         if status == "done" and entry.get("fingerprint") is None:
+            entry["fingerprint"] = current_fingerprint  # output made before the manifest existed
+         entry["status"] = status
+         by_status[status].append(file_info)
+   return statuses
+
+# `fingerprint` keeps describing the output on disk until a newer one is checked
+def mark_submitted(manifest, files, current_fingerprint):
+   submitted_time = time.time()
+   for file_info in files:
+      entry = manifest[file_info["path"]]
+      entry.update(status="submitted", submitted_fingerprint=current_fingerprint, submitted_time=submitted_time)
+
+def print_status(statuses):
+   for LFN, by_status in statuses.items():
+      n_total = sum(len(files) for files in by_status.values())
+      n_done = len(by_status["done"])
+      events_done = sum(f.get("entries") or 0 for f in by_status["done"])
+      events_total = sum(f.get("entries") or 0 for files in by_status.values() for f in files)
+      fraction = 100 * n_done / n_total if n_total else 100
+      print(f"{LFN}")
+      print(f"  {n_done}/{n_total} files done ({fraction:.1f}%), {events_done}/{events_total} events")
+      print(f"  missing: {len(by_status['missing'])}, truncated: {len(by_status['truncated'])}, stale: {len(by_status['stale'])}")
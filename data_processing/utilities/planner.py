@@ -0,0 +1,73 @@
+import statistics
+
+# Groups input files into jobs of roughly `target_events` entries or
+# `target_bytes` bytes (first-fit decreasing). Files are dicts with at least
+# "path" and optionally "entries"/"bytes"; files of unknown size get their own job.
+
+# Separator used for the list of files of one job in the args_*.dat files.
+# Commas and spaces are already taken by the condor `queue ... from` syntax.
+JOB_LIST_SEP = ";"
+
+def file_weight(file_info, key):
+   value = file_info.get(key)
+   return None if value is None else int(value)
+
+def plan_jobs(files, target_events=None, target_bytes=None):
+   if target_events:
+      key, target = "entries", int(target_events)
+   elif target_bytes:
+      key, target = "bytes", int(target_bytes)
+   else:
+      return [[f] for f in files]
+
+   jobs, loads = [], []
+   unknown = [f for f in files if file_weight(f, key) is None]
+   known = sorted((f for f in files if file_weight(f, key) is not None), key=lambda f: file_weight(f, key), reverse=True)
+
+   for f in known:
+      weight = file_weight(f, key)
+      for i, load in enumerate(loads):
+         if load + weight <= target:
+            jobs[i].append(f)
+            loads[i] += weight
+            break
+      else:
+         jobs.append([f])
+         loads.append(weight)
+
+   jobs.extend([f] for f in unknown)
+   # Keep the files of each job in their original order
+   order = {id(f): i for i, f in enumerate(files)}
+   return [sorted(job, key=lambda f: order[id(f)]) for job in jobs]
+
+def job_paths(job):
+   return JOB_LIST_SEP.join(f["path"] for f in job)
+
+def split_job_paths(paths):
+   return [p for p in paths.split(JOB_LIST_SEP) if p]
+
+def _summary(values):
+   if not values:
+      return "n/a"
+   return f"min {min(values)}, median {int(statistics.median(values))}, max {max(values)}"
+
+# Dry-run report of the job size distribution
+def report(jobs, n_bins=10):
+   n_files = sum(len(job) for job in jobs)
+   events = [sum(file_weight(f, "entries") or 0 for f in job) for job in jobs]
+   sizes = [sum(file_weight(f, "bytes") or 0 for f in job) for job in jobs]
+
+   print(f"Planned {len(jobs)} jobs from {n_files} files")
+   print(f"  files/job : {_summary([len(job) for job in jobs])}")
+   print(f"  events/job: {_summary(events)}")
+   print(f"  MB/job    : {_summary([s // 1024**2 for s in sizes])}")
+
+   if events and max(events) > 0:
+      width = max(events) / n_bins
+      counts = [0] * n_bins
+      for n in events:
+         counts[min(int(n / width), n_bins - 1)] += 1
+      print("  events/job histogram:")
+      for i, count in enumerate(counts):
+         bar = "#" * round(40 * count / max(counts))
+         print(f"    [{int(i * width):>10}, {int((i + 1) * width):>10}) {bar} {count}")
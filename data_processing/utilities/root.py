@@ -1,6 +1,13 @@
+import os
+import ast
+import json
+import shutil
 import uproot
 import awkward as ak
+import numpy as np
 import tables
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 def write_carray(array, h5file, name, group_path='/', **kwargs):
         h5file.create_carray(group_path, name, obj=array, createparents=True, **kwargs)
@@ -13,25 +20,437 @@ def pad_or_truncate(jagged_array, max_len):
     
     return np_array
 
-def root_to_h5(input_file, tree_name, branches, output_file, max_len=10):
-    upfile = uproot.open(input_file)
-    tree = upfile[tree_name]
+# Friend files written by the filter in "friend" output mode only hold the new
+# branches, the event keys and the path of the NanoAOD file they were made from
+FRIEND_KEYS = ["run", "luminosityBlock", "event"]
+SOURCE_FILE_KEY = "source_file"
 
+# Dense int64 code per (run, luminosityBlock, event), comparable between both key sets
+def event_codes(keys_a, keys_b):
+    n_a = len(keys_a[FRIEND_KEYS[0]])
+    codes = None
+    for name in FRIEND_KEYS:
+        _, column = np.unique(np.concatenate([keys_a[name], keys_b[name]]), return_inverse=True)
+        column = column.astype(np.int64)
+        if codes is not None:
+            _, codes = np.unique(codes * (column.max() + 1) + column, return_inverse=True)
+        else:
+            codes = column
+    return codes[:n_a], codes[n_a:]
+
+# Index of every friend event in the source tree
+def match_events(source_keys, friend_keys):
+    if len(friend_keys[FRIEND_KEYS[0]]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if len(source_keys[FRIEND_KEYS[0]]) == 0:
+        raise RuntimeError("Friend tree has events but its source tree is empty")
+
+    source_codes, friend_codes = event_codes(source_keys, friend_keys)
+    order = np.argsort(source_codes, kind="stable")
+    pos = np.searchsorted(source_codes, friend_codes, sorter=order)
+    index = order[np.clip(pos, 0, len(order) - 1)]
+    if np.any(source_codes[index] != friend_codes):
+        raise RuntimeError("Friend tree has events that are not in its source tree")
+    return index
+
+# Index of every friend event in the source tree, computed once per file from the keys only
+def source_index(upfile, tree, tree_name, **open_options):
+    if SOURCE_FILE_KEY not in upfile:
+        raise KeyError(f"Branches not found and no '{SOURCE_FILE_KEY}' to join them from")
+    source_path = str(upfile[SOURCE_FILE_KEY])
+    source_tree = uproot.open(source_path, **open_options)[tree_name]
+
+    friend_keys = tree.arrays(FRIEND_KEYS, library="np")
+    source_keys = source_tree.arrays(FRIEND_KEYS, library="np")
+    return source_tree, match_events(source_keys, friend_keys)
+
+# Read `branches` of the source events matched by `index` (one chunk of the friend tree).
+# The filter keeps the source order, so the entry range read stays as short as the chunk.
+def join_source_branches(source_tree, index, branches):
+    if len(index) == 0:
+        source_arrays = source_tree.arrays(branches, entry_start=0, entry_stop=0, library="ak")
+        return {name: source_arrays[name] for name in branches}
+    start, stop = int(index.min()), int(index.max()) + 1
+    source_arrays = source_tree.arrays(branches, entry_start=start, entry_stop=stop, library="ak")
+    return {name: source_arrays[name][index - start] for name in branches}
+
+# Ragged storage of a jagged branch: group "/<name>" with the flat RAGGED_VALUES and
+# the RAGGED_OFFSETS (n_events + 1) of every event, nothing is padded or dropped
+RAGGED_VALUES = "values"
+RAGGED_OFFSETS = "offsets"
+RaggedBlock = namedtuple("RaggedBlock", ["values", "counts"])
+
+def is_jagged(array):
+    return isinstance(array.layout, ak.contents.ListOffsetArray)
+
+# jagged: "pad" (fixed max_len per event) or "ragged"
+def to_numpy_block(array, max_len, jagged="pad"):
+    if not is_jagged(array):
+        return ak.to_numpy(array)
+    if jagged == "ragged":
+        return RaggedBlock(ak.to_numpy(ak.flatten(array)), ak.to_numpy(ak.num(array)).astype(np.int64))
+    return pad_or_truncate(array, max_len)  # shape [N, max-len-length]
+
+# compression: {complib, complevel, shuffle, bitshuffle} as in tables.Filters, e.g.
+# complib "zlib", "blosc:lz4", "blosc:zstd" or "blosc2:zstd". No complib, no compression.
+def h5_filters(compression=None):
+    if not compression or not compression.get("complib"):
+        return None
+    return tables.Filters(complib=compression["complib"],
+                          complevel=int(compression.get("complevel") or 5),
+                          shuffle=bool(compression.get("shuffle", True)),
+                          bitshuffle=bool(compression.get("bitshuffle", False)))
+
+def append_earray(block, h5file, name, group_path='/', chunk_rows=None, **kwargs):
+    node_path = f"{group_path.rstrip('/')}/{name}"
+    if node_path not in h5file:
+        atom = tables.Atom.from_dtype(block.dtype)
+        chunkshape = (int(chunk_rows),) + block.shape[1:] if chunk_rows else None
+        h5file.create_earray(group_path, name, atom=atom, shape=(0,) + block.shape[1:],
+                             expectedrows=kwargs.pop("expectedrows", len(block)), chunkshape=chunkshape,
+                             createparents=True, **kwargs)
+    h5file.get_node(node_path).append(block)
+
+def append_ragged(block, h5file, name, **kwargs):
+    group_path = f"/{name}"
+    offsets_path = f"{group_path}/{RAGGED_OFFSETS}"
+    last = h5file.get_node(offsets_path)[-1] if offsets_path in h5file else None
+    if last is None:
+        offsets = np.concatenate([[0], np.cumsum(block.counts)])
+    else:
+        offsets = last + np.cumsum(block.counts)
+    append_earray(offsets.astype(np.int64), h5file, RAGGED_OFFSETS, group_path=group_path, **kwargs)
+    append_earray(block.values, h5file, RAGGED_VALUES, group_path=group_path, **kwargs)
+
+def append_block(block, h5file, name, **kwargs):
+    if isinstance(block, RaggedBlock):
+        append_ragged(block, h5file, name, **kwargs)
+    else:
+        append_earray(block, h5file, name=name, **kwargs)
+
+# "matrix" layout: every scalar branch except the label in one float32 array of
+# events x features, named EVENT_MATRIX, with the branch names in its COLUMNS_ATTR
+# attribute. The label and jagged branches are still written as their own arrays.
+EVENT_MATRIX = "events"
+COLUMNS_ATTR = "columns"
+
+# (column names, events x features matrix or None, the other blocks)
+def split_event_matrix(blocks, label=None):
+    columns = [name for name, block in blocks.items()
+               if isinstance(block, np.ndarray) and block.ndim == 1 and name != label]
+    others = {name: block for name, block in blocks.items() if name not in columns}
+    if not columns:
+        return columns, None, others
+    return columns, np.stack([blocks[name].astype(np.float32) for name in columns], axis=1), others
+
+def append_event_matrix(blocks, h5file, label=None, **kwargs):
+    columns, matrix, others = split_event_matrix(blocks, label)
+    for name, block in others.items():
+        append_block(block, h5file, name, **kwargs)
+    if matrix is None:
+        return
+    new_node = f"/{EVENT_MATRIX}" not in h5file
+    append_earray(matrix, h5file, name=EVENT_MATRIX, **kwargs)
+    if new_node:
+        h5file.get_node(f"/{EVENT_MATRIX}").attrs[COLUMNS_ATTR] = np.array(columns, dtype="S")
+
+def is_ragged_group(node):
+    return isinstance(node, tables.Group) and RAGGED_OFFSETS in node
+
+# Events in an .h5 output, from its first array or ragged group
+def h5_entries(h5file):
+    for node in h5file.iter_nodes("/"):
+        if is_ragged_group(node):
+            return node._f_get_child(RAGGED_OFFSETS).nrows - 1
+        if isinstance(node, tables.Leaf):
+            return node.nrows
+    return 0
+
+# Branches stored in an .h5 output, matrix columns included
+def h5_columns(h5file):
+    names = set()
+    for node in h5file.iter_nodes("/"):
+        if node._v_name == EVENT_MATRIX:
+            names.update(name.decode() if isinstance(name, bytes) else str(name) for name in node.attrs[COLUMNS_ATTR])
+        else:
+            names.add(node._v_name)
+    return names
+
+# Requested branches/derived columns not yet in `output_file` (all of them if it does not exist)
+def missing_columns(output_file, names):
+    if not os.path.exists(output_file):
+        return list(names)
+    try:
+        with tables.open_file(output_file, mode="r") as h5file:
+            present = h5_columns(h5file)
+    except (OSError, tables.HDF5ExtError):
+        return list(names)  # unreadable, converted again
+    return [name for name in names if name not in present]
+
+# Chunks of at most `step_size` ("100 MB" or a number of entries) as dicts of awkward arrays.
+# Empty trees still give one empty chunk so the output has every array.
+def iterate_chunks(upfile, tree, tree_name, branches, step_size, **open_options):
+    available = set(tree.keys())
+    present = [name for name in branches if name in available]
+    missing = [name for name in branches if name not in available]
+    if missing:
+        source_tree, index = source_index(upfile, tree, tree_name, **open_options)
+
+    if tree.num_entries == 0:
+        chunks = [tree.arrays(present, library="ak")]
+    else:
+        chunks = tree.iterate(present, step_size=step_size or tree.num_entries, library="ak")
+
+    entry_start = 0
+    for chunk in chunks:
+        arrays = {name: chunk[name] for name in chunk.fields}
+        entry_stop = entry_start + len(chunk)
+        if missing:
+            arrays.update(join_source_branches(source_tree, index[entry_start:entry_stop], missing))
+        entry_start = entry_stop
+        yield arrays
+
+# Runs `iterator` one item ahead in a background thread, so the next chunk is read
+# and decompressed while the current one is written
+def prefetch(iterator):
+    iterator = iter(iterator)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(next, iterator, None)
+        while True:
+            item = future.result()
+            if item is None:
+                return
+            future = pool.submit(next, iterator, None)
+            yield item
+
+# Derived columns: {name: expression} over branch names, evaluated per chunk on the
+# awkward arrays, e.g. "A_Zmass / A_Wmass", "Lep1Z_pt + Lep2Z_pt" or "(nLeptons == 3) & (Z_pass > 0)".
+# np and ak are available for functions such as np.abs or ak.num.
+EXPRESSION_NAMESPACE = {"np": np, "ak": ak, "abs": abs}
+
+def expression_branches(expression):
+    names = {node.id for node in ast.walk(ast.parse(expression, mode="eval")) if isinstance(node, ast.Name)}
+    return sorted(names - set(EXPRESSION_NAMESPACE))
+
+def derived_branches(derived):
+    return sorted({name for expression in (derived or {}).values() for name in expression_branches(expression)})
+
+def evaluate_derived(arrays, derived):
+    namespace = {"__builtins__": {}, **EXPRESSION_NAMESPACE, **arrays}
+    return {name: ak.Array(eval(compile(expression, f"<{name}>", "eval"), namespace)) for name, expression in derived.items()}
+
+def report_branch_selection(tree, branches):
+    available = [name for name in branches if name in tree]
+    selected = sum(tree[name].compressed_bytes for name in available)
+    total = sum(branch.compressed_bytes for branch in tree.branches)
+    print(f"Reading {len(available)} of {len(tree.keys())} branches: {selected / 1024**2:.1f} of {total / 1024**2:.1f} MB compressed"
+          f" ({(total - selected) / 1024**2:.1f} MB saved)")
+
+def open_tree(input_file, tree_name, decompression_workers=1):
+    open_options = {}
+    if decompression_workers > 1:
+        open_options["decompression_executor"] = ThreadPoolExecutor(max_workers=decompression_workers)
+    upfile = uproot.open(input_file, **open_options)
+    return upfile, upfile[tree_name], open_options
+
+def close_tree(open_options):
+    if open_options:
+        open_options["decompression_executor"].shutdown()
+
+# numpy blocks of `branches` and the `derived` columns, one dict per chunk, read one
+# chunk ahead. The inputs of derived columns are read but not returned.
+def converted_blocks(upfile, tree, tree_name, branches, open_options, max_len=10, step_size=None, jagged="pad",
+                     derived=None):
+    derived = derived or {}
+    read_branches = list(branches) + [name for name in derived_branches(derived) if name not in branches]
+    report_branch_selection(tree, read_branches)
+
+    def to_blocks(arrays):
+        arrays.update(evaluate_derived(arrays, derived))
+        return {name: to_numpy_block(arrays[name], max_len, jagged) for name in list(branches) + list(derived)}
+
+    chunks = iterate_chunks(upfile, tree, tree_name, read_branches, step_size, **open_options)
+    return prefetch(to_blocks(arrays) for arrays in chunks)
+
+# Streams the tree chunk by chunk into extendable arrays, so memory stays at about one
+# chunk whatever the file size. step_size=None reads the whole tree in one go.
+# chunk_rows sets the HDF5 chunk length: training reads rows at random, so small
+# chunks mean less data decompressed per event. layout is "columns" (one array per
+# branch) or "matrix" (see EVENT_MATRIX). With decompression_workers > 1 uproot
+# decompresses the baskets of each chunk in a thread pool. jagged="ragged" keeps
+# jagged branches whole (see RAGGED_VALUES) instead of padding them to max_len.
+# `derived` columns are written next to `branches`, their inputs are only read.
+# With append=True an existing output only gets the missing branches, as separate
+# arrays, after checking it has the same number of events. The file is written
+# under a .tmp name and moved over the output once complete.
+def root_to_h5(input_file, tree_name, branches, output_file, max_len=10, step_size=None, compression=None, chunk_rows=None,
+               layout="columns", label=None, decompression_workers=1, jagged="pad", derived=None, append=False):
+    upfile, tree, open_options = open_tree(input_file, tree_name, decompression_workers)
     if branches == "all" or branches == ["all"]:
         branches = tree.keys()
-        
-    ak_arrays = tree.arrays(branches, library="ak")
-        
-    with tables.open_file(output_file, mode="w") as h5file:
-        for name in branches:
-            array = ak_arrays[name]
-            
-            if not isinstance(array.layout, ak.contents.ListOffsetArray):
-                np_array = ak.to_numpy(array)
-                write_carray(np_array, h5file, name=name)
-                continue
-            
-            np_array = pad_or_truncate(array, max_len)  # shape [N, max-len-length]
-            write_carray(np_array, h5file, name=name)
-            
-                
+    derived = derived or {}
+
+    tmp_file = f"{output_file}.tmp"
+    mode = "w"
+    if append and os.path.exists(output_file):
+        missing = missing_columns(output_file, list(branches) + list(derived))
+        if not missing:
+            print(f"{output_file} already has every branch, skipping")
+            close_tree(open_options)
+            return
+        with tables.open_file(output_file, mode="r") as h5file:
+            n_existing = h5_entries(h5file)
+        if n_existing != tree.num_entries:
+            close_tree(open_options)
+            raise RuntimeError(f"{output_file} has {n_existing} events but {input_file} has {tree.num_entries}")
+        print(f"Adding {missing} to {output_file}")
+        branches = [name for name in branches if name in missing]
+        derived = {name: expression for name, expression in derived.items() if name in missing}
+        layout = "columns"
+        shutil.copyfile(output_file, tmp_file)
+        mode = "a"
+
+    filters = h5_filters(compression)
+    try:
+        with tables.open_file(tmp_file, mode=mode) as h5file:
+            options = dict(expectedrows=max(1, tree.num_entries), chunk_rows=chunk_rows, filters=filters)
+            for blocks in converted_blocks(upfile, tree, tree_name, branches, open_options, max_len, step_size, jagged, derived):
+                if layout == "matrix":
+                    append_event_matrix(blocks, h5file, label=label, **options)
+                    continue
+                for name, block in blocks.items():
+                    append_block(block, h5file, name, **options)
+    finally:
+        close_tree(open_options)
+    os.replace(tmp_file, output_file)
+
+# .npy output: a directory "<name>.npy.d" with one .npy per array, memory-mappable
+# by the training, and NPY_MANIFEST listing them (and the matrix columns)
+NPY_SUFFIX = ".npy.d"
+NPY_MANIFEST = "manifest.json"
+
+def root_to_npy(input_file, tree_name, branches, output_dir, max_len=10, step_size=None, layout="columns", label=None,
+                decompression_workers=1, jagged="pad", derived=None, **h5_options):
+    if jagged == "ragged":
+        raise ValueError("Ragged jagged storage is only available for .h5 outputs")
+    upfile, tree, open_options = open_tree(input_file, tree_name, decompression_workers)
+    if branches == "all" or branches == ["all"]:
+        branches = tree.keys()
+    n_events = int(tree.num_entries)
+
+    # Written next to the final directory and moved there once complete
+    tmp_dir = f"{output_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    arrays = {}
+    manifest = {"n_events": n_events, "arrays": {}}
+    entry_start = 0
+    try:
+        for blocks in converted_blocks(upfile, tree, tree_name, branches, open_options, max_len, step_size, jagged, derived):
+            if layout == "matrix":
+                columns, matrix, blocks = split_event_matrix(blocks, label)
+                if matrix is not None:
+                    blocks[EVENT_MATRIX] = matrix
+                    manifest[COLUMNS_ATTR] = columns
+            for name, block in blocks.items():
+                if name not in manifest["arrays"]:
+                    shape = (n_events,) + block.shape[1:]
+                    manifest["arrays"][name] = {"file": f"{name}.npy", "dtype": str(block.dtype), "shape": list(shape)}
+                path = os.path.join(tmp_dir, f"{name}.npy")
+                if n_events == 0:
+                    np.save(path, block)  # an empty memmap cannot be created
+                    continue
+                if name not in arrays:
+                    arrays[name] = np.lib.format.open_memmap(path, mode="w+", dtype=block.dtype,
+                                                             shape=tuple(manifest["arrays"][name]["shape"]))
+                arrays[name][entry_start:entry_start + len(block)] = block
+            entry_start += len(next(iter(blocks.values()))) if blocks else 0
+    finally:
+        close_tree(open_options)
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    with open(os.path.join(tmp_dir, NPY_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(tmp_dir, output_dir)
+
+def _convert_one(input_file, output_file, tree_name, branches, options):
+    options = dict(options)
+    if options.pop("output_format", "h5") == "npy":
+        root_to_npy(input_file, tree_name, branches, output_file, **options)
+    else:
+        root_to_h5(input_file, tree_name, branches, output_file, **options)
+    return input_file
+
+# Converts (input, output) pairs with `n_workers` processes, the cpus left over
+# go to uproot decompression inside each file. Raises if any file failed, so the
+# job is retried.
+def convert_files(input_files, output_files, tree_name, branches, n_workers=1, n_cpus=None, **options):
+    n_workers = max(1, min(n_workers, len(input_files)))
+    options["decompression_workers"] = max(1, (n_cpus or n_workers) // n_workers)
+
+    failed = []
+    if n_workers == 1:
+        for input_file, output_file in zip(input_files, output_files):
+            print(f"Converting {input_file}")
+            try:
+                _convert_one(input_file, output_file, tree_name, branches, options)
+            except Exception as e:
+                print(f"Failed {input_file}: {e!r}")
+                failed.append(input_file)
+    else:
+        print(f"Converting {len(input_files)} files with {n_workers} workers")
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_convert_one, input_file, output_file, tree_name, branches, options): input_file
+                       for input_file, output_file in zip(input_files, output_files)}
+            for future in as_completed(futures):
+                try:
+                    print(f"Converted {future.result()}")
+                except Exception as e:
+                    print(f"Failed {futures[future]}: {e!r}")
+                    failed.append(futures[future])
+
+    if failed:
+        raise RuntimeError(f"{len(failed)}/{len(input_files)} files failed: {failed}")
+
+# Objects per event of every jagged branch, accumulated over files as bincounts
+def multiplicity_histograms(input_files, tree_name, branches, step_size="100 MB"):
+    histograms = {}
+    for input_file in input_files:
+        with uproot.open(input_file) as upfile:
+            tree = upfile[tree_name]
+            names = tree.keys() if branches == "all" or branches == ["all"] else branches
+            names = [name for name in names if name in tree and isinstance(tree[name].interpretation, uproot.AsJagged)]
+            for chunk in tree.iterate(names, step_size=step_size, library="ak"):
+                for name in names:
+                    counts = np.bincount(ak.to_numpy(ak.num(chunk[name])))
+                    previous = histograms.get(name, np.zeros(0, dtype=np.int64))
+                    size = max(len(previous), len(counts))
+                    histograms[name] = np.pad(previous, (0, size - len(previous))) + np.pad(counts, (0, size - len(counts)))
+    return histograms
+
+# (events with objects beyond max_len, objects dropped) when padding to max_len
+def truncation(histogram, max_len):
+    multiplicity = np.arange(len(histogram))
+    over = multiplicity > max_len
+    return int(histogram[over].sum()), int(((multiplicity[over] - max_len) * histogram[over]).sum())
+
+# Smallest max_len that keeps `percentile` % of the events whole
+def suggest_max_len(histogram, percentile=99.9):
+    if histogram.sum() == 0:
+        return 0
+    return int(np.searchsorted(np.cumsum(histogram), percentile / 100 * histogram.sum()))
+
+def report_max_len(histograms, percentile=99.9, current_max_len=10):
+    print(f"{'branch':<30} {'max':>5} {'p' + str(percentile):>8} {'events cut':>11} {'objects cut':>12}"
+          f" {'objects cut at ' + str(current_max_len):>20}")
+    suggestions = {}
+    for name, histogram in sorted(histograms.items()):
+        max_len = suggest_max_len(histogram, percentile)
+        events_cut, objects_cut = truncation(histogram, max_len)
+        _, objects_cut_current = truncation(histogram, current_max_len)
+        suggestions[name] = max_len
+        print(f"{name:<30} {len(histogram) - 1:>5} {max_len:>8} {events_cut:>11} {objects_cut:>12} {objects_cut_current:>20}")
+    return suggestions
@@ -0,0 +1,107 @@
+import os
+import shutil
+import numpy as np
+import tables
+import utilities.root as root
+import utilities.planner as planner
+import shared.shards as shard_format
+from shared.shards import SHARDS_DIR, SOURCE_FILES, SOURCE_FILE, SOURCE_ENTRY, PROVENANCE
+
+# Compaction of the per-file .h5 outputs of one experiment directory into a few
+# shards of about target_events/target_bytes, written to "<exp_dir>/shards" with
+# the provenance arrays and manifest described in shared/shards.py. Rows are
+# copied in blocks of COPY_BLOCK_BYTES, so no file is ever loaded whole.
+
+COPY_BLOCK_BYTES = 64 * 1024**2
+
+# Top-level arrays and ragged groups, provenance arrays excluded
+def data_nodes(h5file):
+    return [node for node in h5file.iter_nodes("/") if node._v_name not in PROVENANCE
+            and (isinstance(node, tables.Leaf) or root.is_ragged_group(node))]
+
+def copy_rows(node, h5file, name, group_path="/", start=0, stop=None, shift=0, **kwargs):
+    stop = node.nrows if stop is None else stop
+    step = max(1, COPY_BLOCK_BYTES // max(1, node.rowsize))
+    for block_start in range(start, stop, step):
+        block = node.read(block_start, min(block_start + step, stop))
+        root.append_earray(block + shift if shift else block, h5file, name, group_path=group_path, **kwargs)
+
+def copy_ragged(group, h5file, name, **kwargs):
+    offsets = group._f_get_child(root.RAGGED_OFFSETS)
+    group_path = f"/{name}"
+    offsets_path = f"{group_path}/{root.RAGGED_OFFSETS}"
+    if offsets_path in h5file:
+        # Continue after the last offset already written, skipping the leading 0
+        shift, start = int(h5file.get_node(offsets_path)[-1]), 1
+    else:
+        shift, start = 0, 0
+    copy_rows(offsets, h5file, root.RAGGED_OFFSETS, group_path=group_path, start=start, shift=shift, **kwargs)
+    copy_rows(group._f_get_child(root.RAGGED_VALUES), h5file, root.RAGGED_VALUES, group_path=group_path, **kwargs)
+
+def append_source(source_path, shard_file, source_id, **kwargs):
+    with tables.open_file(source_path, mode="r") as source:
+        n_entries = root.h5_entries(source)
+        nodes = data_nodes(source)
+        # Every array must have one row per event of the shard, so all sources need the same ones
+        if source_id > 0:
+            names = sorted(node._v_name for node in nodes)
+            shard_names = sorted(node._v_name for node in data_nodes(shard_file))
+            if names != shard_names:
+                raise ValueError(f"{source_path} has arrays {names}, the rest of the shard has {shard_names}")
+        for node in nodes:
+            name = node._v_name
+            if root.is_ragged_group(node):
+                copy_ragged(node, shard_file, name, **kwargs)
+                continue
+            new_node = f"/{name}" not in shard_file
+            copy_rows(node, shard_file, name, **kwargs)
+            if name == root.EVENT_MATRIX:
+                columns = node.attrs[root.COLUMNS_ATTR]
+                if new_node:
+                    shard_file.get_node(f"/{name}").attrs[root.COLUMNS_ATTR] = columns
+                elif list(shard_file.get_node(f"/{name}").attrs[root.COLUMNS_ATTR]) != list(columns):
+                    raise ValueError(f"{source_path} has different '{name}' columns than the rest of the shard")
+
+    root.append_earray(np.full(n_entries, source_id, dtype=np.int32), shard_file, SOURCE_FILE, **kwargs)
+    root.append_earray(np.arange(n_entries, dtype=np.int64), shard_file, SOURCE_ENTRY, **kwargs)
+    return n_entries
+
+def write_shard(source_paths, shard_path, compression=None, chunk_rows=None):
+    options = dict(filters=root.h5_filters(compression), chunk_rows=chunk_rows)
+    tmp_path = f"{shard_path}.tmp"
+    n_entries = 0
+    with tables.open_file(tmp_path, mode="w") as shard_file:
+        for source_id, source_path in enumerate(source_paths):
+            n_entries += append_source(source_path, shard_file, source_id, **options)
+        shard_file.create_array("/", SOURCE_FILES, obj=np.array([os.path.basename(p) for p in source_paths], dtype="S"))
+    os.replace(tmp_path, shard_path)
+    return n_entries
+
+def plan_shards(exp_dir, target_events=None, target_bytes=None):
+    files = []
+    for path in shard_format.list_h5_files(exp_dir):
+        with tables.open_file(path, mode="r") as h5file:
+            files.append({"path": path, "entries": root.h5_entries(h5file), "bytes": os.path.getsize(path)})
+    return planner.plan_jobs(files, target_events, target_bytes)
+
+# Shards are written next to each other in a temporary directory that replaces
+# "<exp_dir>/shards" only once all of them are complete
+def compact_directory(exp_dir, target_events=None, target_bytes=None, compression=None, chunk_rows=None, dry_run=False):
+    shards = plan_shards(exp_dir, target_events, target_bytes)
+    print(f"{exp_dir}: {sum(len(s) for s in shards)} files -> {len(shards)} shards")
+    if dry_run or not shards:
+        return shards
+
+    shards_dir = os.path.join(exp_dir, SHARDS_DIR)
+    tmp_dir = f"{shards_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for i, shard in enumerate(shards):
+        shard_path = os.path.join(tmp_dir, f"shard_{i:05d}.h5")
+        n_entries = write_shard([f["path"] for f in shard], shard_path, compression, chunk_rows)
+        print(f"  {os.path.basename(shard_path)}: {len(shard)} files, {n_entries} events")
+    shard_format.write_manifest(tmp_dir, [f["path"] for shard in shards for f in shard])
+
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    os.rename(tmp_dir, shards_dir)
+    return shards
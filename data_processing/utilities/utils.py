@@ -1,6 +1,10 @@
 import subprocess
 import yaml
 import json
+import shared.utils as shared_utils
+
+# "1.5GB", "500 MB", "2048" -> bytes
+parse_size = shared_utils.parse_size
 
 def require_key(config, key):
    if key not in config:
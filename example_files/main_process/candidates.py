@@ -0,0 +1,66 @@
+# Batched Z/W candidate building for a chunk of events.
+# Leptons are the jagged awkward records produced by columnar_filter.good_leptons
+# (electrons then muons, each sorted by pt, with cached four-vectors).
+import awkward as ak
+import kinematics
+
+Z_MASS = 91.1876
+
+
+# All same-flavour opposite-sign pairs of every event, as indices into `leptons`.
+# Pairs are built per flavour so e-mu combinations are never materialized; since
+# electrons come before muons the pair order is the same as
+# itertools.combinations over the whole list, which keeps the tie-breaking of
+# LeptonFilter.findBestZCandidate.
+def sfos_pairs(leptons):
+    index = ak.local_index(leptons, axis=1)
+    pairs = []
+    for flavour in (11, 13):
+        same_flavour = index[abs(leptons.pdgId) == flavour]
+        pairs.append(ak.combinations(same_flavour, 2, axis=1))
+    i1, i2 = ak.unzip(ak.concatenate(pairs, axis=1))
+
+    opposite_sign = (leptons.charge[i1] + leptons.charge[i2]) == 0
+    return i1[opposite_sign], i2[opposite_sign]
+
+# Per event, the SFOS pair with mass closest to the Z mass. Indices and mass are
+# returned with keepdims, i.e. [[i]] or [[None]] for events without any SFOS pair.
+def best_z_pairs(leptons, z_mass=Z_MASS):
+    i1, i2 = sfos_pairs(leptons)
+    pair_mass = kinematics.invariant_mass(kinematics.p4_of(leptons[i1]), kinematics.p4_of(leptons[i2]))
+    best = ak.argmin(abs(pair_mass - z_mass), axis=1, keepdims=True)
+    return i1[best], i2[best], pair_mass[best]
+
+def w_lepton_id(leptons):
+    return (((abs(leptons.pdgId) == 11) & (leptons.cutBased == 4) & (leptons.pt >= 50)) |
+            ((abs(leptons.pdgId) == 13) & (leptons.highPtId == 2) & (leptons.pt >= 70)))
+
+# Highest-pt W lepton among the leptons not used by the Z pair, as one masked
+# argmax over the chunk. Same keepdims convention as best_z_pairs.
+def best_w_leptons(leptons, z1, z2):
+    index = ak.local_index(leptons, axis=1)
+    z1 = ak.fill_none(ak.firsts(z1, axis=1), -1)
+    z2 = ak.fill_none(ak.firsts(z2, axis=1), -1)
+    eligible = (index != z1) & (index != z2) & w_lepton_id(leptons)
+    return ak.argmax(ak.mask(leptons.pt, eligible), axis=1, keepdims=True)
+
+
+def _pick(leptons, index):
+    picked = ak.firsts(leptons[index], axis=1)
+    return {field: ak.to_numpy(ak.fill_none(picked[field], 0)) for field in leptons.fields}
+
+def _found(index):
+    return ak.to_numpy(~ak.is_none(ak.firsts(index, axis=1)))
+
+# Flat per-event view of the chosen candidates, ready for the channel assignment
+def build_candidates(leptons, z_mass=Z_MASS):
+    z1, z2, zmass = best_z_pairs(leptons, z_mass)
+    w = best_w_leptons(leptons, z1, z2)
+    return {
+        "found_z": _found(z1),
+        "found_w": _found(w),
+        "zmass": ak.to_numpy(ak.fill_none(ak.firsts(zmass, axis=1), 0)),
+        "l1": _pick(leptons, z1),
+        "l2": _pick(leptons, z2),
+        "lw": _pick(leptons, w),
+    }
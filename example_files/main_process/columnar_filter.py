@@ -0,0 +1,187 @@
+# Columnar version of the LeptonFilter selection in filterNanoAOD.py.
+# Events are read in chunks with uproot and every selection step is an array
+# operation over the whole chunk instead of a Python loop over events.
+import os
+import json
+import numpy as np
+import awkward as ak
+import uproot
+import kinematics
+import candidates
+import output_buffer
+
+ELECTRON_BRANCHES = ["Electron_pt", "Electron_eta", "Electron_phi", "Electron_pdgId", "Electron_charge", "Electron_cutBased"]
+MUON_BRANCHES = ["Muon_pt", "Muon_eta", "Muon_phi", "Muon_pdgId", "Muon_charge", "Muon_highPtId", "Muon_ip3d"]
+EVENT_BRANCHES = ["MET_pt", "MET_phi", "HLT_Mu50", "HLT_Ele32_WPTight_Gsf", "run", "luminosityBlock", "event"]
+
+# Input branches copied to the output, same as the ones kept by branchsel.txt
+PASSTHROUGH_BRANCHES = ["run", "luminosityBlock", "event", "nElectron", "nMuon", "MET_pt", "MET_phi",
+                        "HLT_Ele32_WPTight_Gsf", "HLT_Mu50", "HLT_OldMu100", "HLT_Photon200", "HLT_TkMu100"]
+
+
+def load_lumi_mask(json_path):
+    with open(json_path) as f:
+        golden = json.load(f)
+    return {int(run): np.asarray(ranges) for run, ranges in golden.items()}
+
+def lumi_mask(runs, lumis, golden):
+    keep = np.zeros(len(runs), dtype=bool)
+    for run in np.unique(runs):
+        ranges = golden.get(int(run))
+        if ranges is None:
+            continue
+        sel = runs == run
+        lumi = lumis[sel]
+        ok = np.zeros(len(lumi), dtype=bool)
+        for lo, hi in ranges:
+            ok |= (lumi >= lo) & (lumi <= hi)
+        keep[sel] = ok
+    return keep
+
+
+def _as_float(array):
+    return ak.values_astype(array, np.float64)
+
+def _as_int(array):
+    return ak.values_astype(array, np.int32)
+
+def good_electrons(events):
+    ele = ak.zip({
+        "pt": _as_float(events["Electron_pt"]),
+        "eta": _as_float(events["Electron_eta"]),
+        "phi": _as_float(events["Electron_phi"]),
+        "pdgId": _as_int(events["Electron_pdgId"]),
+        "charge": _as_int(events["Electron_charge"]),
+        "cutBased": _as_int(events["Electron_cutBased"]),
+        "highPtId": _as_int(events["Electron_cutBased"]) * 0 - 1,
+    })
+    ele = ele[(ele.pt > 10) & (abs(ele.eta) < 2.5) & (ele.cutBased >= 2)]
+    return ele[ak.argsort(ele.pt, axis=1, ascending=False, stable=True)]
+
+def good_muons(events):
+    mu = ak.zip({
+        "pt": _as_float(events["Muon_pt"]),
+        "eta": _as_float(events["Muon_eta"]),
+        "phi": _as_float(events["Muon_phi"]),
+        "pdgId": _as_int(events["Muon_pdgId"]),
+        "charge": _as_int(events["Muon_charge"]),
+        "cutBased": _as_int(events["Muon_highPtId"]) * 0 - 1,
+        "highPtId": _as_int(events["Muon_highPtId"]),
+    })
+    mu = mu[(mu.pt > 20) & (abs(mu.eta) < 2.4) & (events["Muon_ip3d"] < 0.01) & (mu.highPtId >= 1)]
+    return mu[ak.argsort(mu.pt, axis=1, ascending=False, stable=True)]
+
+# Same ordering as the per-event path: electrons first, then muons.
+# Four-vectors are built here once per lepton and reused for every pair.
+def good_leptons(events):
+    leptons = ak.concatenate([good_electrons(events), good_muons(events)], axis=1)
+    return kinematics.with_four_vector(leptons)
+
+def fill_channels(buffer, cand, nlep, met_pt, met_phi):
+    l1, l2, lw = cand["l1"], cand["l2"], cand["lw"]
+
+    three_lep = nlep >= 3
+    found_z = three_lep & cand["found_z"]
+    found_w = found_z & cand["found_w"]
+
+    buffer.set("nLeptons", nlep)
+    buffer.set("3Lep_pass", 1, three_lep)
+    buffer.set("Z_pass", 1, found_z)
+    buffer.set("W_pass", 1, found_w)
+
+    p4_1, p4_2, p4_w = kinematics.p4_of(l1), kinematics.p4_of(l2), kinematics.p4_of(lw)
+
+    values = {
+        "nlep": nlep,
+        "pass": 1,
+        "ptZ": np.sqrt(l1["pt"]**2 + l2["pt"]**2),
+        "Dr_Z": kinematics.delta_r(l1["eta"], l1["phi"], l2["eta"], l2["phi"]),
+        "Dphi_Z": kinematics.delta_phi(l1["phi"], l2["phi"]),
+        "Deta_Z": kinematics.delta_eta(l1["eta"], l2["eta"]),
+        "Zmass": cand["zmass"],
+        "Wmass": kinematics.met_mass(p4_w, met_pt, met_phi),
+        "Sum_mass": kinematics.invariant_mass(p4_1, p4_2, p4_w),
+        "Sum_pt": l1["pt"] + l2["pt"] + lw["pt"],
+    }
+    for i, lep in ((1, l1), (2, l2)):
+        for var in ("pt", "eta", "phi"):
+            values[f"Lep{i}Z_{var}"] = lep[var]
+    for var in ("pt", "eta", "phi"):
+        values[f"Lep3W_{var}"] = lw[var]
+
+    z_ele = (abs(l1["pdgId"]) == 11) & (abs(l2["pdgId"]) == 11)
+    z_mu = (abs(l1["pdgId"]) == 13) & (abs(l2["pdgId"]) == 13)
+    w_ele = abs(lw["pdgId"]) == 11
+    w_mu = abs(lw["pdgId"]) == 13
+    high_pt = (((l1["highPtId"] == 2) & np.isin(l2["highPtId"], (1, 2))) |
+               ((l2["highPtId"] == 2) & np.isin(l1["highPtId"], (1, 2))))
+
+    masks = {
+        "A": found_w & z_ele & w_ele,
+        "B": found_w & z_ele & w_mu,
+        "C": found_w & z_mu & w_ele & high_pt,
+        "D": found_w & z_mu & w_mu & high_pt,
+    }
+    for channel, mask in masks.items():
+        buffer.set_channel(channel, values, mask)
+    return buffer
+
+
+def process_chunk(events, dataset_id):
+    buffer = output_buffer.OutputBuffer(len(events))
+
+    buffer.set("Dataset_ID", dataset_id)
+    buffer.set("HLTMU50", ak.to_numpy(events["HLT_Mu50"]))
+    buffer.set("HLTEle32", ak.to_numpy(events["HLT_Ele32_WPTight_Gsf"]))
+
+    leptons = good_leptons(events)
+    nlep = ak.to_numpy(ak.num(leptons, axis=1))
+    cand = candidates.build_candidates(leptons)
+
+    met_pt = ak.to_numpy(_as_float(events["MET_pt"]))
+    met_phi = ak.to_numpy(_as_float(events["MET_phi"]))
+    return fill_channels(buffer, cand, nlep, met_pt, met_phi)
+
+
+# friend=True writes only the new branches plus the event keys, see output_buffer.FRIEND_KEYS
+def run_columnar(input_file, output_dir, dataset_id, json_path=None, tree_name="Events",
+                 postfix=None, step_size="100 MB", friend=False):
+    upfile = uproot.open(input_file)
+    tree = upfile[tree_name]
+    available = set(tree.keys())
+    passthrough = output_buffer.FRIEND_KEYS if friend else PASSTHROUGH_BRANCHES
+    passthrough = [b for b in passthrough if b in available]
+    if postfix is None:
+        postfix = output_buffer.FRIEND_POSTFIX if friend else "_Skim"
+    read_branches = sorted(set(ELECTRON_BRANCHES + MUON_BRANCHES + EVENT_BRANCHES + passthrough))
+
+    golden = load_lumi_mask(json_path) if json_path else None
+
+    os.makedirs(output_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    output_file = os.path.join(output_dir, f"{base_name}{postfix}.root")
+
+    out_tree = None
+    with uproot.recreate(output_file) as fout:
+        for events in tree.iterate(read_branches, step_size=step_size, library="ak"):
+            if golden is not None:
+                keep = lumi_mask(ak.to_numpy(events["run"]), ak.to_numpy(events["luminosityBlock"]), golden)
+                events = events[keep]
+
+            inputs = {b: ak.to_numpy(events[b]) for b in passthrough}
+            buffer = process_chunk(events, dataset_id)
+
+            if out_tree is None:
+                types = {name: array.dtype for name, array in inputs.items()}
+                types.update(output_buffer.numpy_types())
+                out_tree = fout.mktree(tree_name, types)
+            buffer.flush(out_tree, extra=inputs)
+
+        if out_tree is None:
+            fout.mktree(tree_name, output_buffer.numpy_types())
+
+        if friend:
+            fout[output_buffer.SOURCE_FILE_KEY] = input_file
+
+    print(f"Columnar filter output: {output_file}")
+    return output_file
@@ -7,6 +7,8 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 import math
 import itertools
+import kinematics
+import output_buffer
 
 
 MAPPING_FILE = "src/ml_framework/data_processing/mapping.json"  # JSON file to store dataset mappings
@@ -31,8 +33,21 @@ JSON_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "Cert_314472
 # JSON_PATH = "/eos/user/u/you/certs/Cert_Collisions2023_366403_370790_Golden.json"
 
 
+# --- helper: look up a file in the metadata catalogue built at submission (ROOT_CATALOGUE) ---
+def catalogue_entry(path):
+    catalogue_path = os.environ.get("ROOT_CATALOGUE")
+    if not catalogue_path or not os.path.exists(catalogue_path):
+        return None
+    with open(catalogue_path) as f:
+        return json.load(f).get(path)
+
+
 # --- helper: DATA if no genWeight branch ---
 def is_data_file(path):
+    entry = catalogue_entry(path)
+    if entry is not None:
+        return entry["is_data"]
+
     f = ROOT.TFile.Open(path)
     if not f or f.IsZombie(): raise RuntimeError(f"Cannot open: {path}")
     t = f.Get("Events")
@@ -42,45 +57,18 @@ def is_data_file(path):
     return not has_genw
 
 class LeptonFilter(Module):
-    def __init__(self, dataset_folder):
+    def __init__(self, dataset_folder, dataset_id=None):
         self.minLeptons = 3
-        self.dataset_id = get_dataset_id(dataset_folder)  # Get dataset ID from JSON
+        if dataset_id is None:
+            dataset_id = get_dataset_id(dataset_folder)  # Get dataset ID from JSON
+        self.dataset_id = dataset_id
         print(f"DATASET_ID = {self.dataset_id}")
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        self.buffer = output_buffer.EventRow()  # reset every event
 
-        branches = ["Zmass", "Wmass", "Dr_Z", "Dphi_Z","Deta_Z", "Sum_pt", "Sum_mass", "ptZ","nlep","pass"]
-        
-        for channel in ['A', 'B', 'C', 'D']:
-             self.out.branch(f"{channel}_Lep3W_pt", "F")
-             self.out.branch(f"{channel}_Lep3W_eta", "F")
-             self.out.branch(f"{channel}_Lep3W_phi", "F")
-             for branch in branches:
-                 self.out.branch(f"{channel}_{branch}", "F")
-             for i in range(1, 3):
-                 self.out.branch(f"{channel}_Lep{i}Z_pt", "F")
-                 self.out.branch(f"{channel}_Lep{i}Z_eta", "F")
-                 self.out.branch(f"{channel}_Lep{i}Z_phi", "F")
-
-        self.out.branch(f"B_mu1ip3d", "F")
-        self.out.branch(f"C_mu1ip3d", "F")
-        self.out.branch(f"C_mu2ip3d", "F")
-        self.out.branch(f"D_mu1ip3d", "F")
-        self.out.branch(f"D_mu2ip3d", "F")
-        self.out.branch(f"D_mu3ip3d", "F")
-
-        self.out.branch("Dataset_ID", "I")  # Store dataset as integer
-        self.out.branch("3Lep_pass", "I")
-        self.out.branch("Z_pass", "I")
-        self.out.branch("W_pass", "I")
-        self.out.branch("A_Wpass", "I")
-        self.out.branch("B_Wpass", "I")
-        self.out.branch("C_Wpass", "I")
-        self.out.branch("D_Wpass", "I")
-        self.out.branch("nLeptons", "I")
-        self.out.branch("HLTMU50", "I")
-        self.out.branch("HLTEle32", "I")
+        output_buffer.declare_branches(self.out)
  
  
         inputTree.SetBranchStatus("event",1)
@@ -107,18 +95,15 @@ class LeptonFilter(Module):
 
         
     def analyze(self, event):
+        buffer = self.buffer
+        buffer.reset()
 
-        self.out.fillBranch("Dataset_ID", self.dataset_id)  # Store dataset as integer
-
-        hltmu50 = event.HLT_Mu50
-        hltele32 = event.HLT_Ele32_WPTight_Gsf
-
-        self.out.fillBranch("HLTMU50",hltmu50)
-        self.out.fillBranch("HLTEle32",hltele32)
+        buffer.set("Dataset_ID", self.dataset_id)  # Store dataset as integer
+        buffer.set("HLTMU50", event.HLT_Mu50)
+        buffer.set("HLTEle32", event.HLT_Ele32_WPTight_Gsf)
         
         electrons = Collection(event, "Electron")
         muons = Collection(event, "Muon")
-        leptons = list(muons) + list(electrons)
         
         met_pt = event.MET_pt 
         met_phi = event.MET_phi
@@ -129,105 +114,19 @@ class LeptonFilter(Module):
         #---------------MUONES
         good_muons = sorted([mu for mu in muons if mu.pt > 20 and abs(mu.eta) < 2.4 and mu.ip3d < 0.01 and mu.highPtId >= 1 ], key=lambda x: x.pt, reverse=True)
 
-
-        self.out.fillBranch("A_pass", 0)
-        self.out.fillBranch("B_pass", 0)
-        self.out.fillBranch("C_pass", 0)
-        self.out.fillBranch("D_pass", 0)
-
-        self.out.fillBranch("3Lep_pass",0)
-        self.out.fillBranch("Z_pass",0)
-        self.out.fillBranch("W_pass",0)
-        self.out.fillBranch("A_Wpass",0)
-        self.out.fillBranch("B_Wpass",0)
-        self.out.fillBranch("C_Wpass",0)
-        self.out.fillBranch("D_Wpass",0)
-
-        self.out.fillBranch("A_nlep",0);
-        self.out.fillBranch("A_ptZ",-999);
-        self.out.fillBranch("A_Dr_Z",-999);
-        self.out.fillBranch("A_Dphi_Z",-999);
-        self.out.fillBranch("A_Deta_Z",-999);
-        self.out.fillBranch("A_Zmass",-999);
-        self.out.fillBranch("A_Lep1Z_pt",-999);
-        self.out.fillBranch("A_Lep2Z_pt",-999);
-        self.out.fillBranch("A_Lep1Z_eta",-999);
-        self.out.fillBranch("A_Lep2Z_eta",-999);
-        self.out.fillBranch("A_Lep1Z_phi",-999);
-        self.out.fillBranch("A_Lep2Z_phi",-999);        
-        self.out.fillBranch("A_Wmass",-999);        
-        self.out.fillBranch("A_Sum_mass",-999);        
-        self.out.fillBranch("A_Lep3W_pt",-999);        
-        self.out.fillBranch("A_Lep3W_eta",-999);        
-        self.out.fillBranch("A_Lep3W_phi",-999);
-
-        self.out.fillBranch("B_nlep",0);
-        self.out.fillBranch("B_ptZ",-999);
-        self.out.fillBranch("B_Dr_Z",-999);
-        self.out.fillBranch("B_Dphi_Z",-999);
-        self.out.fillBranch("B_Deta_Z",-999);
-        self.out.fillBranch("B_Zmass",-999);
-        self.out.fillBranch("B_Lep1Z_pt",-999);
-        self.out.fillBranch("B_Lep2Z_pt",-999);
-        self.out.fillBranch("B_Lep1Z_eta",-999);
-        self.out.fillBranch("B_Lep2Z_eta",-999);
-        self.out.fillBranch("B_Lep1Z_phi",-999);
-        self.out.fillBranch("B_Lep2Z_phi",-999);        
-        self.out.fillBranch("B_Wmass",-999);        
-        self.out.fillBranch("B_Sum_mass",-999);        
-        self.out.fillBranch("B_Lep3W_pt",-999);        
-        self.out.fillBranch("B_Lep3W_eta",-999);        
-        self.out.fillBranch("B_Lep3W_phi",-999);
-
-        self.out.fillBranch("C_nlep",0);
-        self.out.fillBranch("C_ptZ",-999);
-        self.out.fillBranch("C_Dr_Z",-999);
-        self.out.fillBranch("C_Dphi_Z",-999);
-        self.out.fillBranch("C_Deta_Z",-999);
-        self.out.fillBranch("C_Zmass",-999);
-        self.out.fillBranch("C_Lep1Z_pt",-999);
-        self.out.fillBranch("C_Lep2Z_pt",-999);
-        self.out.fillBranch("C_Lep1Z_eta",-999);
-        self.out.fillBranch("C_Lep2Z_eta",-999);
-        self.out.fillBranch("C_Lep1Z_phi",-999);
-        self.out.fillBranch("C_Lep2Z_phi",-999);        
-        self.out.fillBranch("C_Wmass",-999);        
-        self.out.fillBranch("C_Sum_mass",-999);        
-        self.out.fillBranch("C_Lep3W_pt",-999);        
-        self.out.fillBranch("C_Lep3W_eta",-999);        
-        self.out.fillBranch("C_Lep3W_phi",-999);
-
-        self.out.fillBranch("D_nlep",0);
-        self.out.fillBranch("D_ptZ",-999);
-        self.out.fillBranch("D_Dr_Z",-999);
-        self.out.fillBranch("D_Dphi_Z",-999);
-        self.out.fillBranch("D_Deta_Z",-999);
-        self.out.fillBranch("D_Zmass",-999);
-        self.out.fillBranch("D_Lep1Z_pt",-999);
-        self.out.fillBranch("D_Lep2Z_pt",-999);
-        self.out.fillBranch("D_Lep1Z_eta",-999);
-        self.out.fillBranch("D_Lep2Z_eta",-999);
-        self.out.fillBranch("D_Lep1Z_phi",-999);
-        self.out.fillBranch("D_Lep2Z_phi",-999);        
-        self.out.fillBranch("D_Wmass",-999);        
-        self.out.fillBranch("D_Sum_mass",-999);        
-        self.out.fillBranch("D_Lep3W_pt",-999);        
-        self.out.fillBranch("D_Lep3W_eta",-999);        
-        self.out.fillBranch("D_Lep3W_phi",-999);        
-        
         good_leptons = good_electrons + good_muons
+        self.cacheLorentzVectors(good_leptons)
         
-        self.out.fillBranch("nLeptons", len(good_leptons)) #numero de leptones por evento
+        buffer.set("nLeptons", len(good_leptons)) #numero de leptones por evento
 
-        
         if len(good_leptons) >= self.minLeptons:
 
-            self.out.fillBranch("3Lep_pass",1);
+            buffer.set("3Lep_pass", 1)
 
             foundZ, pair, best_Zmass = self.findBestZCandidate(good_leptons)
             
             if foundZ:
-                self.out.fillBranch("Z_pass",1);
+                buffer.set("Z_pass", 1)
 
                 l1,l2 = pair
 
@@ -235,208 +134,68 @@ class LeptonFilter(Module):
                                 
                 foundW, lepW = self.findBestWCandidate(leptons)
 
-                if foundW:
-
-                     self.out.fillBranch("W_pass",1);
-                     
-                     ####### A channel (eeenu) ############
-                     if abs(l1.pdgId) == 11 and abs(l2.pdgId) == 11 and abs(lepW.pdgId) == 11:  
-                
-                         self.out.fillBranch("A_pass", 1)
-                         self.out.fillBranch("A_nlep", len(good_leptons))
-                        
-                         lepton1_pt = l1.pt
-                         lepton2_pt = l2.pt
-                         lepton1_eta = l1.eta
-                         lepton2_eta = l2.eta
-                         lepton1_phi = l1.phi
-                         lepton2_phi = l2.phi
-                         ptZ = math.sqrt(l1.pt**2 + l2.pt**2)
-                       
-                         dr,dphi,deta = self.dr_l1l2_Z(pair)
-                         self.out.fillBranch("A_ptZ", ptZ)
-                         self.out.fillBranch("A_Dr_Z", dr)
-                         self.out.fillBranch("A_Dphi_Z", dphi)
-                         self.out.fillBranch("A_Deta_Z", deta)
-                         self.out.fillBranch("A_Zmass", best_Zmass)
-                         self.out.fillBranch("A_Lep1Z_pt", lepton1_pt)
-                         self.out.fillBranch("A_Lep2Z_pt", lepton2_pt)
-                         self.out.fillBranch("A_Lep1Z_eta", lepton1_eta)
-                         self.out.fillBranch("A_Lep2Z_eta", lepton2_eta)
-                         self.out.fillBranch("A_Lep1Z_phi", lepton1_phi)
-                         self.out.fillBranch("A_Lep2Z_phi", lepton2_phi)
-                        
-                         lepton3_pt = lepW.pt
-                         lepton3_eta = lepW.eta
-                         lepton3_phi = lepW.phi
-                        
-                         W_mass = self.WMass(lepW, met_pt, met_phi)
-                         self.out.fillBranch("A_Wmass", W_mass)
-                
-                         total_mass = self.Total_Mass(l1,l2, lepW)
-                         self.out.fillBranch("A_Sum_mass", total_mass)
-                         self.out.fillBranch("A_Lep3W_pt", lepton3_pt)
-                         self.out.fillBranch("A_Lep3W_eta", lepton3_eta)
-                         self.out.fillBranch("A_Lep3W_phi", lepton3_phi)
-                           
-                         total_pt = lepton1_pt + lepton2_pt + lepton3_pt
-                         self.out.fillBranch("A_Sum_pt", total_pt)
-
-
-                         ####### B channel (eemunu) ############
-                     if abs(l1.pdgId) == 11 and abs(l2.pdgId) == 11 and abs(lepW.pdgId) == 13:  
-                
-                         self.out.fillBranch("B_pass", 1)
-                         self.out.fillBranch("B_nlep", len(good_leptons))
-                        
-                         lepton1_pt = l1.pt
-                         lepton2_pt = l2.pt
-                         lepton1_eta = l1.eta
-                         lepton2_eta = l2.eta
-                         lepton1_phi = l1.phi
-                         lepton2_phi = l2.phi
-                         ptZ = math.sqrt(l1.pt**2 + l2.pt**2)
-                       
-                         dr,dphi,deta = self.dr_l1l2_Z(pair)
-                         self.out.fillBranch("B_ptZ", ptZ)
-                         self.out.fillBranch("B_Dr_Z", dr)
-                         self.out.fillBranch("B_Dphi_Z", dphi)
-                         self.out.fillBranch("B_Deta_Z", deta)
-                         self.out.fillBranch("B_Zmass", best_Zmass)
-                         self.out.fillBranch("B_Lep1Z_pt", lepton1_pt)
-                         self.out.fillBranch("B_Lep2Z_pt", lepton2_pt)
-                         self.out.fillBranch("B_Lep1Z_eta", lepton1_eta)
-                         self.out.fillBranch("B_Lep2Z_eta", lepton2_eta)
-                         self.out.fillBranch("B_Lep1Z_phi", lepton1_phi)
-                         self.out.fillBranch("B_Lep2Z_phi", lepton2_phi)
-                        
-                         lepton3_pt = lepW.pt
-                         lepton3_eta = lepW.eta
-                         lepton3_phi = lepW.phi
-                        
-                         W_mass = self.WMass(lepW, met_pt, met_phi)
-                         self.out.fillBranch("B_Wmass", W_mass)
-                
-                         total_mass = self.Total_Mass(l1,l2, lepW)
-                         self.out.fillBranch("B_Sum_mass", total_mass)
-                         self.out.fillBranch("B_Lep3W_pt", lepton3_pt)
-                         self.out.fillBranch("B_Lep3W_eta", lepton3_eta)
-                         self.out.fillBranch("B_Lep3W_phi", lepton3_phi)
-                           
-                         total_pt = lepton1_pt + lepton2_pt + lepton3_pt
-                         self.out.fillBranch("B_Sum_pt", total_pt)
-
-                         ####### C channel (mumue) ############
-                     if abs(l1.pdgId) == 13 and abs(l2.pdgId) == 13 and abs(lepW.pdgId) == 11 and ( (l1.highPtId == 2 and (l2.highPtId == 1 or l2.highPtId == 2)) or (l2.highPtId == 2 and (l1.highPtId == 1 or l1.highPtId == 2)) ):
-                         
-                         self.out.fillBranch("C_pass", 1)
-                         self.out.fillBranch("C_nlep", len(good_leptons))
-                        
-                         lepton1_pt = l1.pt
-                         lepton2_pt = l2.pt
-                         lepton1_eta = l1.eta
-                         lepton2_eta = l2.eta
-                         lepton1_phi = l1.phi
-                         lepton2_phi = l2.phi
-                         ptZ = math.sqrt(l1.pt**2 + l2.pt**2)
-                       
-                         dr,dphi,deta = self.dr_l1l2_Z(pair)
-                         self.out.fillBranch("C_ptZ", ptZ)
-                         self.out.fillBranch("C_Dr_Z", dr)
-                         self.out.fillBranch("C_Dr_Z", dphi)
-                         self.out.fillBranch("C_Zmass", best_Zmass)
-                         self.out.fillBranch("C_Lep1Z_pt", lepton1_pt)
-                         self.out.fillBranch("C_Lep2Z_pt", lepton2_pt)
-                         self.out.fillBranch("C_Lep1Z_eta", lepton1_eta)
-                         self.out.fillBranch("C_Lep2Z_eta", lepton2_eta)
-                         self.out.fillBranch("C_Lep1Z_phi", lepton1_phi)
-                         self.out.fillBranch("C_Lep2Z_phi", lepton2_phi)
-                        
-                         lepton3_pt = lepW.pt
-                         lepton3_eta = lepW.eta
-                         lepton3_phi = lepW.phi
-                        
-                         W_mass = self.WMass(lepW, met_pt, met_phi)
-                         self.out.fillBranch("C_Wmass", W_mass)
-                
-                         total_mass = self.Total_Mass(l1,l2, lepW)
-                         self.out.fillBranch("C_Sum_mass", total_mass)
-                         self.out.fillBranch("C_Lep3W_pt", lepton3_pt)
-                         self.out.fillBranch("C_Lep3W_eta", lepton3_eta)
-                         self.out.fillBranch("C_Lep3W_phi", lepton3_phi)
-                           
-                         total_pt = lepton1_pt + lepton2_pt + lepton3_pt
-                         self.out.fillBranch("C_Sum_pt", total_pt)
-
-                         ####### D channel (mumumum) ############
-                     if abs(l1.pdgId) == 13 and abs(l2.pdgId) == 13 and abs(lepW.pdgId) == 13 and( (l1.highPtId == 2 and (l2.highPtId == 1 or l2.highPtId == 2)) or (l2.highPtId == 2 and (l1.highPtId == 1 or l1.highPtId == 2)) ):
+                channel = self.findChannel(l1, l2, lepW) if foundW else None
 
-                
-                         self.out.fillBranch("D_pass", 1)
-                         self.out.fillBranch("D_nlep", len(good_leptons))
-                        
-                         lepton1_pt = l1.pt
-                         lepton2_pt = l2.pt
-                         lepton1_eta = l1.eta
-                         lepton2_eta = l2.eta
-                         lepton1_phi = l1.phi
-                         lepton2_phi = l2.phi
-                         ptZ = math.sqrt(l1.pt**2 + l2.pt**2)
-                       
-                         dr,dphi,deta = self.dr_l1l2_Z(pair)
-                         self.out.fillBranch("D_ptZ", ptZ)
-                         self.out.fillBranch("D_Dr_Z", dr)
-                         self.out.fillBranch("D_Dphi_Z", dphi)
-                         self.out.fillBranch("D_Deta_Z", deta)
-                         self.out.fillBranch("D_Zmass", best_Zmass)
-                         self.out.fillBranch("D_Lep1Z_pt", lepton1_pt)
-                         self.out.fillBranch("D_Lep2Z_pt", lepton2_pt)
-                         self.out.fillBranch("D_Lep1Z_eta", lepton1_eta)
-                         self.out.fillBranch("D_Lep2Z_eta", lepton2_eta)
-                         self.out.fillBranch("D_Lep1Z_phi", lepton1_phi)
-                         self.out.fillBranch("D_Lep2Z_phi", lepton2_phi)
-                        
-                         lepton3_pt = lepW.pt
-                         lepton3_eta = lepW.eta
-                         lepton3_phi = lepW.phi
-                        
-                         W_mass = self.WMass(lepW, met_pt, met_phi)
-                         self.out.fillBranch("D_Wmass", W_mass)
-                
-                         total_mass = self.Total_Mass(l1,l2, lepW)
-                         self.out.fillBranch("D_Sum_mass", total_mass)
-                         self.out.fillBranch("D_Lep3W_pt", lepton3_pt)
-                         self.out.fillBranch("D_Lep3W_eta", lepton3_eta)
-                         self.out.fillBranch("D_Lep3W_phi", lepton3_phi)
-                           
-                         total_pt = lepton1_pt + lepton2_pt + lepton3_pt
-                         self.out.fillBranch("D_Sum_pt", total_pt)
-
-                         
+                if foundW:
+                     buffer.set("W_pass", 1)
+
+                if channel:
+                     dr,dphi,deta = self.dr_l1l2_Z(pair)
+                     values = {
+                         "pass": 1,
+                         "nlep": len(good_leptons),
+                         "ptZ": math.sqrt(l1.pt**2 + l2.pt**2),
+                         "Dr_Z": dr,
+                         "Dphi_Z": dphi,
+                         "Deta_Z": deta,
+                         "Zmass": best_Zmass,
+                         "Lep1Z_pt": l1.pt,
+                         "Lep2Z_pt": l2.pt,
+                         "Lep1Z_eta": l1.eta,
+                         "Lep2Z_eta": l2.eta,
+                         "Lep1Z_phi": l1.phi,
+                         "Lep2Z_phi": l2.phi,
+                         "Wmass": self.WMass(lepW, met_pt, met_phi),
+                         "Sum_mass": self.Total_Mass(l1, l2, lepW),
+                         "Lep3W_pt": lepW.pt,
+                         "Lep3W_eta": lepW.eta,
+                         "Lep3W_phi": lepW.phi,
+                         "Sum_pt": l1.pt + l2.pt + lepW.pt,
+                     }
+                     buffer.set_channel(channel, values)
+
+        buffer.write(self.out)
         return True     
 
+    # A (eeenu), B (eemunu), C (mumuenu), D (mumumunu); the channels are exclusive
+    def findChannel(self, l1, l2, lepW):
+        z_flavour = abs(l1.pdgId) if abs(l1.pdgId) == abs(l2.pdgId) else None
+        w_flavour = abs(lepW.pdgId)
+
+        if z_flavour == 11:
+            return {11: "A", 13: "B"}.get(w_flavour)
+        if z_flavour == 13:
+            high_pt = (l1.highPtId == 2 and l2.highPtId in (1, 2)) or (l2.highPtId == 2 and l1.highPtId in (1, 2))
+            if high_pt:
+                return {11: "C", 13: "D"}.get(w_flavour)
+        return None
         
     def etaphiplane(self, lepton1, lepton2):
         dr_etaphi = ()       
     
     def computeInvariantMass(self, lepton1, lepton2):
-        e1, px1, py1, pz1 = self.getLorentzVector(lepton1)
-        e2, px2, py2, pz2 = self.getLorentzVector(lepton2)
-        mass2 = (e1 + e2) ** 2 - (px1 + px2) ** 2 - (py1 + py2) ** 2 - (pz1 + pz2) ** 2
-        return math.sqrt(mass2) if mass2 > 0 else 0
+        return kinematics.scalar_invariant_mass(self.getLorentzVector(lepton1), self.getLorentzVector(lepton2))
     
+    # Build the four-vector of each good lepton once per event,
+    # every helper below then reuses it instead of recomputing
+    def cacheLorentzVectors(self, leptons):
+        self.p4_cache = {id(lepton): kinematics.scalar_lepton_four_vector(lepton.pt, lepton.eta, lepton.phi, lepton.pdgId)
+                         for lepton in leptons}
+
     def getLorentzVector(self, lepton):
-        
-        
-        m_lepton = 0.000511 if abs(lepton.pdgId) == 11 else 0.105  # Electron: 0.511 MeV, Muon: 105 MeV
-        e = math.sqrt(lepton.pt**2 * math.cosh(lepton.eta)**2 + 0.000511**2)  # Electron mass ~0.511 MeV
-        px = lepton.pt * math.cos(lepton.phi)
-        py = lepton.pt * math.sin(lepton.phi)
-        pz = lepton.pt * math.sinh(lepton.eta)
-        return e, px, py, pz
+        return self.p4_cache[id(lepton)]
         
     def findBestZCandidate(self, leptons, z_mass: float = 91.1876):
-        import itertools
         best_pair = None
         best_mass = None
         min_diff = float("inf")
@@ -477,71 +236,88 @@ class LeptonFilter(Module):
     
     
     def WMass(self, lepton, met_pt, met_phi):
-        e, px, py, pz = self.getLorentzVector(lepton)
-        
         #El MET puede tratarse como un neutrino con energia igual a MET_pt
         # y phi igual a MET_phi
-        met_px = met_pt * math.cos(met_phi)
-        met_py = met_pt * math.sin(met_phi)
-        
-        met_e = met_pt
-        
-        mass2 = (e + met_e) ** 2 - (px + met_px) ** 2 - (py + met_py) ** 2 - (pz) ** 2
-        return math.sqrt(mass2) if mass2 > 0 else 0
+        return kinematics.scalar_met_mass(self.getLorentzVector(lepton), met_pt, met_phi)
         
     def Total_Mass(self, lepton1, lepton2, lepton3):
-        
-        #Obtener los 4-vectores de los dos leptones
-        e1, px1, py1, pz1 = self.getLorentzVector(lepton1)
-        e2, px2, py2, pz2 = self.getLorentzVector(lepton2)
-        e3, px3, py3, pz3 = self.getLorentzVector(lepton3)
-
-        
-        #Calcular la masa invariante (M^2 = E^2 - p^2)
-        mass2 = (e1 + e2 + e3) ** 2 - (px1 + px2 + px3) ** 2 - (py1 + py2 + py3) ** 2 - (pz1 + pz2 + pz3) ** 2
-        return math.sqrt(mass2) if mass2 > 0 else 0
+        #Masa invariante de los 3 leptones con los 4-vectores ya calculados
+        return kinematics.scalar_invariant_mass(self.getLorentzVector(lepton1),
+                                                self.getLorentzVector(lepton2),
+                                                self.getLorentzVector(lepton3))
         
        
     def dr_l1l2_Z(self, best_pair):
-        dr_max = 1.5
         if best_pair:           # 
            lepton1, lepton2 = best_pair
-           dphi = (lepton1.phi - lepton2.phi + math.pi) % (2 * math.pi) - math.pi
-           deta = lepton1.eta - lepton2.eta # 
-           dr = math.sqrt(dphi**2 + deta**2) 
+           dphi = kinematics.scalar_delta_phi(lepton1.phi, lepton2.phi)
+           deta = lepton1.eta - lepton2.eta
+           dr = kinematics.scalar_delta_r(lepton1.eta, lepton1.phi, lepton2.eta, lepton2.phi)
            return dr,dphi,deta
         else:
            return 0
                
 
 # Main execution
-inputFile = sys.argv[1]
-dataset_folder = sys.argv[2]
-outputDir = sys.argv[3]
-
-mods = [LeptonFilter(dataset_folder)]
-
-# 1) Build kwargs FIRST
-pp_kwargs = dict(
-    outputDir=outputDir,
-    inputFiles=[inputFile],
-    cut=None,
-    branchsel="src/ml_training/data_processing/example/branchsel.txt",
-    outputbranchsel=None,
-    modules=mods,
-    noOut=False,
-    justcount=False,
-)
-
-# 2) Add JSON only for DATA
-if is_data_file(inputFile):
-    if not os.path.exists(JSON_PATH):
+if __name__ == "__main__":
+    inputFiles = [f for f in sys.argv[1].split(";") if f]  # one job may process several files
+    dataset_folder = sys.argv[2]
+    outputDir = sys.argv[3]
+
+    # "event" runs LeptonFilter through the PostProcessor, "columnar" runs columnar_filter.py
+    processing_mode = os.environ.get("PROCESSING_MODE", "event")
+    # "full" rewrites the NanoAOD content plus the new branches, "friend" only
+    # writes the new branches and the run/luminosityBlock/event keys
+    friend = os.environ.get("OUTPUT_MODE", "full") == "friend"
+
+    # All files of a job come from the same dataset
+    is_data = is_data_file(inputFiles[0])
+    if is_data and not os.path.exists(JSON_PATH):
         raise FileNotFoundError(f"Detected DATA but JSON not found: {JSON_PATH}")
-    pp_kwargs["jsonInput"] = JSON_PATH  # filter bad lumis BEFORE modules
-
-# 3) Run
-p = PostProcessor(**pp_kwargs)
-p.run()
-
-
 
+    if processing_mode == "columnar":
+        import columnar_filter
+        dataset_id = get_dataset_id(dataset_folder)
+        for inputFile in inputFiles:
+            columnar_filter.run_columnar(
+                inputFile,
+                outputDir,
+                dataset_id,
+                json_path=JSON_PATH if is_data else None,
+                friend=friend,
+            )
+        sys.exit(0)
+
+    mods = [LeptonFilter(dataset_folder)]
+
+    # 1) Build kwargs FIRST
+    pp_kwargs = dict(
+        outputDir=outputDir,
+        inputFiles=inputFiles,
+        cut=None,
+        branchsel="src/ml_training/data_processing/example/branchsel.txt",
+        outputbranchsel=None,
+        modules=mods,
+        noOut=False,
+        justcount=False,
+    )
+
+    # 2) Add JSON only for DATA (filter bad lumis BEFORE modules)
+    if is_data:
+        pp_kwargs["jsonInput"] = JSON_PATH
+
+    if friend:
+        pp_kwargs["outputbranchsel"] = output_buffer.write_friend_branchsel("friend_branchsel.txt")
+        pp_kwargs["postfix"] = output_buffer.FRIEND_POSTFIX
+
+    # 3) Run
+    p = PostProcessor(**pp_kwargs)
+    p.run()
+
+    # Keep track of the source file so the conversion can join NanoAOD branches back
+    if friend:
+        for inputFile in inputFiles:
+            output_name = os.path.splitext(os.path.basename(inputFile))[0] + output_buffer.FRIEND_POSTFIX + ".root"
+            f = ROOT.TFile.Open(os.path.join(outputDir, output_name), "UPDATE")
+            ROOT.TObjString(inputFile).Write(output_buffer.SOURCE_FILE_KEY)
+            f.Close()
@@ -0,0 +1,124 @@
+# Lepton kinematics shared by filterNanoAOD.py and columnar_filter.py.
+# The vectorized kernels take flat NumPy arrays or jagged awkward arrays of
+# (pt, eta, phi, pdgId) and work on the whole batch at once (columnar_filter.py);
+# the scalar_* helpers apply the same formulas to one event (LeptonFilter).
+#
+#   python3 kinematics.py [n_leptons]   runs the micro-benchmarks against the scalar helpers
+import sys
+import math
+import timeit
+import numpy as np
+
+ELECTRON_MASS = 0.000511  # GeV
+MUON_MASS = 0.105         # GeV
+
+
+# Only ufuncs are used below so that the same kernels run on awkward arrays
+def lepton_mass(pdg_id):
+    return MUON_MASS + (ELECTRON_MASS - MUON_MASS) * (abs(pdg_id) == 11)
+
+def four_vector(pt, eta, phi, mass):
+    e = np.sqrt(pt**2 * np.cosh(eta)**2 + mass**2)
+    return e, pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+
+def lepton_four_vector(pt, eta, phi, pdg_id):
+    return four_vector(pt, eta, phi, lepton_mass(pdg_id))
+
+# Add fields e, px, py, pz to an awkward record array of leptons so that the
+# four-vectors are built once and reused by every pair/triplet built from them
+def with_four_vector(leptons):
+    import awkward as ak
+    e, px, py, pz = lepton_four_vector(leptons.pt, leptons.eta, leptons.phi, leptons.pdgId)
+    for name, value in (("e", e), ("px", px), ("py", py), ("pz", pz)):
+        leptons = ak.with_field(leptons, value, name)
+    return leptons
+
+def p4_of(leptons):
+    return leptons["e"], leptons["px"], leptons["py"], leptons["pz"]
+
+def mass(e, px, py, pz):
+    mass2 = e**2 - px**2 - py**2 - pz**2
+    return np.sqrt(np.maximum(mass2, 0))
+
+def invariant_mass(*vectors):
+    e, px, py, pz = (sum(components) for components in zip(*vectors))
+    return mass(e, px, py, pz)
+
+# Lepton + MET system with MET taken as a massless neutrino with pz = 0,
+# as in LeptonFilter.WMass
+def met_mass(vector, met_pt, met_phi):
+    e, px, py, pz = vector
+    return mass(e + met_pt, px + met_pt * np.cos(met_phi), py + met_pt * np.sin(met_phi), pz)
+
+def transverse_mass(pt, phi, met_pt, met_phi):
+    mt2 = 2 * pt * met_pt * (1 - np.cos(delta_phi(phi, met_phi)))
+    return np.sqrt(np.maximum(mt2, 0))
+
+def delta_phi(phi1, phi2):
+    return np.mod(phi1 - phi2 + math.pi, 2 * math.pi) - math.pi
+
+def delta_eta(eta1, eta2):
+    return eta1 - eta2
+
+def delta_r(eta1, phi1, eta2, phi2):
+    return np.sqrt(delta_phi(phi1, phi2)**2 + delta_eta(eta1, eta2)**2)
+
+
+# Scalar versions of the kernels for the per-event LeptonFilter: for the 2-4
+# leptons of one event, building NumPy arrays costs more than the arithmetic
+def scalar_lepton_four_vector(pt, eta, phi, pdg_id):
+    m = ELECTRON_MASS if abs(pdg_id) == 11 else MUON_MASS
+    e = math.sqrt(pt**2 * math.cosh(eta)**2 + m**2)
+    return e, pt * math.cos(phi), pt * math.sin(phi), pt * math.sinh(eta)
+
+def scalar_mass(e, px, py, pz):
+    mass2 = e**2 - px**2 - py**2 - pz**2
+    return math.sqrt(mass2) if mass2 > 0 else 0.0
+
+def scalar_invariant_mass(*vectors):
+    return scalar_mass(*(sum(components) for components in zip(*vectors)))
+
+def scalar_met_mass(vector, met_pt, met_phi):
+    e, px, py, pz = vector
+    return scalar_mass(e + met_pt, px + met_pt * math.cos(met_phi), py + met_pt * math.sin(met_phi), pz)
+
+def scalar_delta_phi(phi1, phi2):
+    return (phi1 - phi2 + math.pi) % (2 * math.pi) - math.pi
+
+def scalar_delta_r(eta1, phi1, eta2, phi2):
+    return math.sqrt(scalar_delta_phi(phi1, phi2)**2 + (eta1 - eta2)**2)
+
+def benchmark(n_leptons=100000, repeat=5, seed=16):
+    rng = np.random.default_rng(seed)
+    pt = rng.exponential(40, (2, n_leptons)) + 10
+    eta = rng.uniform(-2.5, 2.5, (2, n_leptons))
+    phi = rng.uniform(-math.pi, math.pi, (2, n_leptons))
+    pdg_id = rng.choice([11, 13], (2, n_leptons))
+    leptons = [list(zip(pt[i].tolist(), eta[i].tolist(), phi[i].tolist(), pdg_id[i].tolist())) for i in range(2)]
+
+    def loop_mass():
+        return [scalar_invariant_mass(scalar_lepton_four_vector(*l1), scalar_lepton_four_vector(*l2))
+                for l1, l2 in zip(*leptons)]
+
+    def vector_mass():
+        return invariant_mass(lepton_four_vector(pt[0], eta[0], phi[0], pdg_id[0]),
+                              lepton_four_vector(pt[1], eta[1], phi[1], pdg_id[1]))
+
+    def loop_dr():
+        return [scalar_delta_r(l1[1], l1[2], l2[1], l2[2]) for l1, l2 in zip(*leptons)]
+
+    def vector_dr():
+        return delta_r(eta[0], phi[0], eta[1], phi[1])
+
+    results = {}
+    for name, scalar, vector in (("invariant_mass", loop_mass, vector_mass), ("delta_r", loop_dr, vector_dr)):
+        t_scalar = min(timeit.repeat(scalar, number=1, repeat=repeat))
+        t_vector = min(timeit.repeat(vector, number=1, repeat=repeat))
+        results[name] = (t_scalar, t_vector)
+        print(f"{name:>15}: scalar {t_scalar * 1e3:8.2f} ms, vectorized {t_vector * 1e3:8.2f} ms "
+              f"({t_scalar / t_vector:.1f}x) for {n_leptons} pairs")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
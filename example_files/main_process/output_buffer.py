@@ -0,0 +1,146 @@
+# Single schema of the branches written by the lepton filter, a struct-of-arrays
+# buffer holding them for a chunk of events and a row holding them for one event.
+import numpy as np
+
+DEFAULT = -999
+
+CHANNELS = ['A', 'B', 'C', 'D']
+
+# quantity -> (ROOT type, default), written once per channel as "<channel>_<quantity>"
+CHANNEL_QUANTITIES = {
+    "Zmass": ("F", DEFAULT),
+    "Wmass": ("F", DEFAULT),
+    "Dr_Z": ("F", DEFAULT),
+    "Dphi_Z": ("F", DEFAULT),
+    "Deta_Z": ("F", DEFAULT),
+    "Sum_pt": ("F", DEFAULT),
+    "Sum_mass": ("F", DEFAULT),
+    "ptZ": ("F", DEFAULT),
+    "nlep": ("F", 0),
+    "pass": ("F", 0),
+    "Lep1Z_pt": ("F", DEFAULT),
+    "Lep1Z_eta": ("F", DEFAULT),
+    "Lep1Z_phi": ("F", DEFAULT),
+    "Lep2Z_pt": ("F", DEFAULT),
+    "Lep2Z_eta": ("F", DEFAULT),
+    "Lep2Z_phi": ("F", DEFAULT),
+    "Lep3W_pt": ("F", DEFAULT),
+    "Lep3W_eta": ("F", DEFAULT),
+    "Lep3W_phi": ("F", DEFAULT),
+}
+
+EVENT_BRANCHES = {
+    "B_mu1ip3d": ("F", 0),
+    "C_mu1ip3d": ("F", 0),
+    "C_mu2ip3d": ("F", 0),
+    "D_mu1ip3d": ("F", 0),
+    "D_mu2ip3d": ("F", 0),
+    "D_mu3ip3d": ("F", 0),
+    "Dataset_ID": ("I", 0),
+    "3Lep_pass": ("I", 0),
+    "Z_pass": ("I", 0),
+    "W_pass": ("I", 0),
+    "A_Wpass": ("I", 0),
+    "B_Wpass": ("I", 0),
+    "C_Wpass": ("I", 0),
+    "D_Wpass": ("I", 0),
+    "nLeptons": ("I", 0),
+    "HLTMU50": ("I", 0),
+    "HLTEle32": ("I", 0),
+}
+
+ROOT_TYPES = {"F": np.float32, "I": np.int32}
+
+def build_schema():
+    schema = {}
+    for channel in CHANNELS:
+        for quantity, spec in CHANNEL_QUANTITIES.items():
+            schema[f"{channel}_{quantity}"] = spec
+    schema.update(EVENT_BRANCHES)
+    return schema
+
+SCHEMA = build_schema()
+
+def numpy_types(schema=SCHEMA):
+    return {name: ROOT_TYPES[root_type] for name, (root_type, _) in schema.items()}
+
+# Friend output: only the schema branches plus the keys needed to join them
+# back to the source NanoAOD tree, whose path is stored as SOURCE_FILE_KEY
+FRIEND_KEYS = ["run", "luminosityBlock", "event"]
+FRIEND_POSTFIX = "_Friend"
+SOURCE_FILE_KEY = "source_file"
+
+def write_friend_branchsel(path, schema=SCHEMA):
+    lines = ["drop *"] + [f"keep {name}" for name in FRIEND_KEYS + list(schema)]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+# Declare every branch of the schema on a NanoAODTools wrapped output tree
+def declare_branches(wrapped_tree, schema=SCHEMA):
+    for name, (root_type, _) in schema.items():
+        wrapped_tree.branch(name, root_type)
+
+
+class OutputBuffer:
+    def __init__(self, n_events, schema=SCHEMA):
+        self.schema = schema
+        self.n_events = n_events
+        self.columns = {name: np.empty(n_events, dtype=ROOT_TYPES[root_type])
+                        for name, (root_type, _) in schema.items()}
+        self.reset()
+
+    def reset(self):
+        for name, (_, default) in self.schema.items():
+            self.columns[name].fill(default)
+
+    # Write `values` (scalar or per-event array) for the events selected by `mask`
+    def set(self, name, values, mask=None):
+        column = self.columns[name]
+        if mask is None:
+            column[:] = values
+        elif np.ndim(values) == 0:
+            column[mask] = values
+        else:
+            column[mask] = np.asarray(values)[mask]
+
+    def set_channel(self, channel, values, mask=None):
+        for quantity, value in values.items():
+            self.set(f"{channel}_{quantity}", value, mask)
+
+    # Columnar path: append all columns to an uproot WritableTree in one call
+    def flush(self, tree, extra=None):
+        data = dict(extra) if extra else {}
+        data.update(self.columns)
+        tree.extend(data)
+
+
+# Per-event path. NanoAODTools output branches keep their value until filled
+# again, so only the branches set in this event or the previous one are
+# compared with what was last filled, and only the ones that differ are filled.
+class EventRow:
+    def __init__(self, schema=SCHEMA):
+        self.defaults = {name: default for name, (_, default) in schema.items()}
+        self.values = dict(self.defaults)
+        self.filled = {}
+        self.touched = set(schema)  # nothing filled yet
+        self.previous = set()
+
+    def reset(self):
+        self.values = self.defaults.copy()
+        self.previous, self.touched = self.touched, set()
+
+    def set(self, name, value):
+        self.values[name] = value
+        self.touched.add(name)
+
+    def set_channel(self, channel, values):
+        for quantity, value in values.items():
+            self.set(f"{channel}_{quantity}", value)
+
+    def write(self, wrapped_tree):
+        for name in self.touched | self.previous:
+            value = self.values[name]
+            if self.filled.get(name) != value:
+                wrapped_tree.fillBranch(name, value)
+                self.filled[name] = value
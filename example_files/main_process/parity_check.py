@@ -0,0 +1,97 @@
+# Compare the per-event LeptonFilter (PostProcessor) against columnar_filter.py
+# on a synthetic NanoAOD-like file. Must run inside a CMSSW environment with NanoAODTools.
+#
+#   python3 parity_check.py [n_events] [work_dir]
+import os
+import sys
+import numpy as np
+import awkward as ak
+import uproot
+from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+import columnar_filter
+import output_buffer
+from filterNanoAOD import LeptonFilter
+
+
+def make_synthetic_nanoaod(path, n_events=5000, seed=16):
+    rng = np.random.default_rng(seed)
+
+    def collection(n_per_event, pdg, extra):
+        n_total = int(n_per_event.sum())
+        charge = rng.choice([-1, 1], n_total).astype(np.int32)
+        fields = {
+            "pt": rng.exponential(40, n_total).astype(np.float32) + 5,
+            "eta": rng.uniform(-3, 3, n_total).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n_total).astype(np.float32),
+            "charge": charge,
+            "pdgId": (-pdg * charge).astype(np.int32),
+        }
+        fields.update({name: make(n_total) for name, make in extra.items()})
+        return ak.unflatten(ak.zip(fields), n_per_event)
+
+    electrons = collection(rng.poisson(1.5, n_events), 11, {
+        "cutBased": lambda n: rng.integers(0, 5, n).astype(np.int32),
+    })
+    muons = collection(rng.poisson(1.5, n_events), 13, {
+        "highPtId": lambda n: rng.integers(0, 3, n).astype(np.uint8),
+        "ip3d": lambda n: rng.uniform(0, 0.02, n).astype(np.float32),
+        "mass": lambda n: np.full(n, 0.105, dtype=np.float32),
+    })
+
+    branches = {
+        "run": np.ones(n_events, dtype=np.uint32),
+        "luminosityBlock": (np.arange(n_events) // 100 + 1).astype(np.uint32),
+        "event": np.arange(n_events, dtype=np.uint64),
+        "genWeight": np.ones(n_events, dtype=np.float32),
+        "MET_pt": rng.exponential(50, n_events).astype(np.float32),
+        "MET_phi": rng.uniform(-np.pi, np.pi, n_events).astype(np.float32),
+        "HLT_Mu50": rng.integers(0, 2, n_events).astype(bool),
+        "HLT_Ele32_WPTight_Gsf": rng.integers(0, 2, n_events).astype(bool),
+        "Electron": electrons,
+        "Muon": muons,
+    }
+    # NanoAOD naming (nElectron, Electron_pt, ...) spelled out: the defaults of
+    # uproot's dict assignment changed to Electron/Electron.pt in recent versions
+    types = {name: array.type if isinstance(array, ak.Array) else array.dtype for name, array in branches.items()}
+    with uproot.recreate(path) as fout:
+        fout.mktree("Events", types, counter_name=lambda counted: "n" + counted,
+                    field_name=lambda outer, inner: inner if outer == "" else f"{outer}_{inner}")
+        fout["Events"].extend(branches)
+    return path
+
+
+def compare_outputs(event_file, columnar_file, tree_name="Events", atol=1e-4):
+    event_tree = uproot.open(event_file)[tree_name]
+    columnar_tree = uproot.open(columnar_file)[tree_name]
+
+    mismatches = []
+    for name in output_buffer.SCHEMA:
+        expected = event_tree[name].array(library="np")
+        result = columnar_tree[name].array(library="np")
+        if len(expected) != len(result) or not np.allclose(expected, result, rtol=1e-5, atol=atol):
+            n_bad = np.count_nonzero(~np.isclose(expected, result, rtol=1e-5, atol=atol)) if len(expected) == len(result) else -1
+            mismatches.append((name, n_bad))
+    return mismatches
+
+
+def main(n_events, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    input_file = make_synthetic_nanoaod(os.path.join(work_dir, "synthetic_nanoaod.root"), n_events)
+
+    p = PostProcessor(outputDir=work_dir, inputFiles=[input_file], cut=None, branchsel=None,
+                      modules=[LeptonFilter("synthetic", dataset_id=0)], postfix="_event", noOut=False)
+    p.run()
+    event_file = os.path.join(work_dir, "synthetic_nanoaod_event.root")
+    columnar_file = columnar_filter.run_columnar(input_file, work_dir, 0, postfix="_columnar", step_size=1000)
+
+    mismatches = compare_outputs(event_file, columnar_file)
+    for name, n_bad in mismatches:
+        print(f"MISMATCH {name}: {n_bad} events")
+    print(f"Parity check on {n_events} events: {'FAILED' if mismatches else 'OK'}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    work_dir = sys.argv[2] if len(sys.argv) > 2 else "parity_check"
+    sys.exit(main(n_events, work_dir))
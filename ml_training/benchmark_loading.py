@@ -0,0 +1,73 @@
+import argparse
+import time
+import numpy as np
+from torch.utils.data import DataLoader, Dataset, Subset
+import utilities.prepare as prepare
+import utilities.utils as utils
+import models.models as models
+
+DATASETS = {
+    "h5": prepare.h5Dataset,
+    "npy": prepare.npyDataset,
+    "root": prepare.rootDataset,
+}
+
+# Hides __getitems__, i.e. the one-sample-at-a-time path collated by the DataLoader
+class PerEvent(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+# Events/s through a DataLoader over `n_samples` random events, as seen by train_model
+def loading_rate(dataset, n_samples, batch_size, seed=0):
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), size=min(n_samples, len(dataset)), replace=False)
+    dataloader = DataLoader(Subset(dataset, indices.tolist()), batch_size=batch_size, collate_fn=prepare.collate_batch)
+
+    start = time.perf_counter()
+    n_events = 0
+    for x, y in dataloader:
+        n_events += len(y)
+    return n_events / (time.perf_counter() - start)
+
+def main(config_path, inputs, n_samples, batch_size, per_event=False):
+    config = prepare.load_config(config_path)
+    data_config = utils.require_key(config, 'data')
+    features = utils.require_key(data_config, 'features')
+    label = utils.require_key(data_config, 'label')
+    num_classes = utils.require_key(data_config, 'num_classes')
+
+    print(f"{'source':<16} {'events':>12} {'build [s]':>10} {'events/s':>12}")
+    for source, paths in inputs:
+        start = time.perf_counter()
+        dataset = DATASETS[source](paths, features, label, num_classes, transform=models.MLPTransform())
+        build_time = time.perf_counter() - start
+        rate = loading_rate(dataset, n_samples, batch_size)
+        print(f"{source:<16} {len(dataset):>12} {build_time:>10.2f} {rate:>12.0f}")
+        if per_event and hasattr(dataset, "__getitems__"):
+            rate = loading_rate(PerEvent(dataset), n_samples, batch_size)
+            print(f"{source + ' per-event':<16} {len(dataset):>12} {'':>10} {rate:>12.0f}")
+        dataset.close()
+
+def parse_input(value):
+    source, _, paths = value.partition(":")
+    if source not in DATASETS or not paths:
+        raise argparse.ArgumentTypeError(f"Expected <{'|'.join(DATASETS)}>:<dir>[,<dir>...], got '{value}'")
+    return source, paths.split(",")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the data loading throughput of the dataset formats")
+    parser.add_argument('-f', '--file', type=str, help="Path to the configuration file (features, label).", required=True)
+    parser.add_argument('-i', '--inputs', type=parse_input, nargs='+', required=True,
+                        help="Datasets to compare, e.g. h5:converted/exp1 npy:converted_npy/exp1")
+    parser.add_argument('-n', '--n-samples', type=int, default=100000, help="Random events read per dataset.")
+    parser.add_argument('-b', '--batch-size', type=int, default=1024, help="DataLoader batch size.")
+    parser.add_argument('--per-event', action='store_true', help="Also time the per-event path of batched datasets.")
+    args = parser.parse_args()
+
+    main(args.file, args.inputs, args.n_samples, args.batch_size, per_event=args.per_event)
@@ -34,27 +34,54 @@ def main(config_path):
         label_mapping_path = utils.require_key(data_config, 'label_mapping')
         label_mapping = utils.read_json(label_mapping_path)
         label_mapping = utils.int_key_in_dict(label_mapping)
+        max_len = data_config.get('max_jagged_len') or 10
+        loader = data_config.get('loader') or {}
+        
+        # "h5"/"npy" read the converted files, "root" the processed ROOT files directly
+        source = data_config.get('source') or "h5"
+        if source == "root":
+            dataset_class = prepare.rootDataset
+            dataset_options = {
+                "max_len": max_len,
+                "tree_name": data_config.get('tree_name') or "Events",
+                "cache_dir": data_config.get('cache_dir'),
+                "cache_size": data_config.get('cache_size') or "10GB",
+                "memory_chunks": data_config.get('memory_chunks') or 8,
+            }
+        elif source == "npy":
+            dataset_class = prepare.npyDataset
+            dataset_options = {}
+        else:
+            dataset_class = prepare.h5Dataset
+            dataset_options = {"max_len": max_len, "index_path": data_config.get('index_path')}
+        
+        # Only the train/test datasets are read from, the full one just indexes the files
+        split_options = dict(dataset_options)
+        if source == "h5" and data_config.get('preload'):
+            split_options.update(preload=True, preload_memory=data_config.get('preload_memory') or "8GB")
         input_paths = [os.path.abspath(data_path) for data_path in input_paths] # Get absolute path for ray workers, otherwise they will not find the data inside the container
 
         print("Collecting data...")
-        full_dataset = prepare.h5Dataset(input_paths, features, label, num_classes)
+        full_dataset = dataset_class(input_paths, features, label, num_classes, **dataset_options)
         train_idx, test_idx = prepare.split_h5Dataset(full_dataset, 0.2, 16)
-        train_dataset = prepare.h5Dataset(
+        train_dataset = dataset_class(
                 input_paths,
                 features,
                 label,
                 num_classes,
                 transform=models.MLPTransform(),
-                indices=[full_dataset.global_ids[i] for i in train_idx]
+                indices=full_dataset.subset_ids(train_idx),
+                **split_options
             )
         
-        test_dataset = prepare.h5Dataset(
+        test_dataset = dataset_class(
                 input_paths,
                 features,
                 label,
                 num_classes,
                 transform=models.MLPTransform(),
-                indices=[full_dataset.global_ids[i] for i in test_idx]
+                indices=full_dataset.subset_ids(test_idx),
+                **split_options
             )
         
         print("Data collected.")
@@ -67,7 +94,7 @@ def main(config_path):
         
         print("Training and optimizing model...")
         if model_type == 'mlp':
-            opt.tune_mlp(model_name, model_type, train_dataset, ideal_acc, num_models, output_dir)
+            opt.tune_mlp(model_name, model_type, train_dataset, ideal_acc, num_models, output_dir, loader=loader)
             print("MLP training and optimization completed.")
         else:
             print(f"The {model_type} is not available.")
@@ -75,7 +102,7 @@ def main(config_path):
         
         print("testing model...")
         if model_type == 'mlp':
-            tr.test_results(model_name, model_type, test_dataset, output_dir, class_labels=label_mapping)
+            tr.test_results(model_name, model_type, test_dataset, output_dir, class_labels=label_mapping, loader=loader)
             print("MLP testing completed.")
         else:
             print(f"The {model_type} is not available.")
@@ -7,6 +7,10 @@ class MLPTransform:
         flatten = torch.cat([value.flatten() for value in data.values()])
         return flatten
 
+    # Same for a whole batch: {feature: [batch, ...]} -> [batch, n_inputs]
+    def batch(self, data):
+        return torch.cat([value.reshape(len(value), -1) for value in data.values()], dim=1)
+
 class MLPmodel(nn.Module):
     def __init__(self, input_size, output_size, hidden_input_size, hidden_output_size, num_layers):
         super(MLPmodel, self).__init__()
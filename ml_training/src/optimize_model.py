@@ -1,3 +1,4 @@
+import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -13,7 +14,7 @@ from ray.air.integrations.mlflow import MLflowLoggerCallback
 from torch.utils.data import DataLoader
 
 
-def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name):
+def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name, loader=None):
     device = learn.get_device()
     print(f"Device: {device}")
 
@@ -40,13 +41,17 @@ def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name):
     checkpoint_path = f'{output_dir}/best_model_{model_name}.pth'    
 
     
-    train_dataloader, val_dataloader = prepare.split_and_transform_pythorch(dataset, val_split, batch_size)
+    train_dataloader, val_dataloader = prepare.split_and_transform_pythorch(dataset, val_split, batch_size, loader=loader)
 
     for epoch in range(num_epochs):
         model.train()
         
+        # Fraction of the training epoch spent waiting for the DataLoader
+        data_wait = 0.0
+        epoch_start = batch_start = time.perf_counter()
         for X_batch, y_batch in train_dataloader:
-            X_batch, y_batch = X_batch.to(device), y_batch.to(device)
+            data_wait += time.perf_counter() - batch_start
+            X_batch, y_batch = X_batch.to(device, non_blocking=True), y_batch.to(device, non_blocking=True)
             optimizer.zero_grad()
             
             outputs = model(X_batch)
@@ -56,7 +61,8 @@ def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name):
             loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)  # Gradient clipping
             optimizer.step()
-            
+            batch_start = time.perf_counter()
+        data_wait /= time.perf_counter() - epoch_start
 
         val_loss = 0.0
         val_acc = 0.0
@@ -71,8 +77,8 @@ def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name):
         val_loss /= len(val_dataloader)
         val_acc /= len(val_dataloader)
 
-        print(f"Epoch {epoch + 1}/{num_epochs}, Train acc: {acc:.4f}, Train loss: {loss.item():.4f}, Val acc: {val_acc:.4f}, Val loss: {val_loss:.4f}")
-        tune.report({"loss": val_loss, "acc": val_acc, "val_loss": val_loss, "val_acc": val_acc})
+        print(f"Epoch {epoch + 1}/{num_epochs}, Train acc: {acc:.4f}, Train loss: {loss.item():.4f}, Val acc: {val_acc:.4f}, Val loss: {val_loss:.4f}, Data wait: {data_wait:.1%}")
+        tune.report({"loss": val_loss, "acc": val_acc, "val_loss": val_loss, "val_acc": val_acc, "data_wait": data_wait})
 
         # Early stopping check
         if val_acc >= ideal_acc/100:
@@ -93,7 +99,7 @@ def train_model(hyperparam_space, dataset, ideal_acc, output_dir, model_name):
     return 0
 
 
-def tune_mlp(model_name, model_type, dataset, ideal_acc, num_models, output_dir):
+def tune_mlp(model_name, model_type, dataset, ideal_acc, num_models, output_dir, loader=None):
 
     hyperparam_space = {
         "hidden_input_size": tune.choice([64, 128, 256]),
@@ -121,7 +127,8 @@ def tune_mlp(model_name, model_type, dataset, ideal_acc, num_models, output_dir)
     num_gpus = int(resources.get("GPU", 0))
     print(f"CPUs avail: {num_cpus}, GPUs avail: {num_gpus}")
     trainable = tune.with_resources(
-         tune.with_parameters(train_model, dataset=dataset, ideal_acc=ideal_acc, output_dir=output_dir, model_name=model_name),
+         tune.with_parameters(train_model, dataset=dataset, ideal_acc=ideal_acc, output_dir=output_dir, model_name=model_name,
+                              loader=loader),
          resources={"cpu": num_cpus, "gpu": num_gpus} 
          )
     #trainable = tune.with_parameters(train_model, dataset=dataset, ideal_acc=ideal_acc, output_dir=output_dir, model_name=model_name)
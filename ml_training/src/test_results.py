@@ -3,10 +3,10 @@ import torch
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, auc
 import models.models as models
+import utilities.prepare as prepare
 from sklearn.preprocessing import label_binarize
 import numpy as np
 from itertools import cycle
-from torch.utils.data import DataLoader
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 
 def compute_ROC(outputs, labels, num_classes, output_dir, model_name, class_labels=None):
@@ -79,7 +79,7 @@ def compute_cm(outputs, labels, output_dir, model_name, class_labels=None):
     
     return 0
 
-def test_results(model_name, model_type, dataset, output_dir, batch_size=2048, class_labels=None):
+def test_results(model_name, model_type, dataset, output_dir, batch_size=2048, class_labels=None, loader=None):
     
     param_model = torch.load(f"{output_dir}/best_model_{model_name}.pth", weights_only=True)
     
@@ -87,7 +87,7 @@ def test_results(model_name, model_type, dataset, output_dir, batch_size=2048, c
         model = models.MLPmodel.get_model(dataset.num_features, dataset.num_classes, param_model)
     print(model)
     
-    dataloader = DataLoader(dataset, batch_size=batch_size)
+    dataloader = prepare.make_dataloader(dataset, batch_size, loader=loader)
     
     all_outputs = []
     all_labels = []
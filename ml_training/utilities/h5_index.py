@@ -0,0 +1,25 @@
+import shared.file_index as file_index
+
+# Sidecar index of the input files of a directory (events, arrays, matrix columns or
+# clusters), saved as INDEX_NAME next to them. Entries are reused while the files do
+# not change (see shared/file_index.py), by every dataset of the process (kept in
+# memory) and by later runs (read from disk).
+
+INDEX_NAME = ".dataset_index.json"
+_loaded = {}
+
+# {path: entry} of `paths`, scanning only new or changed files with `scan_file`, in parallel
+def build_index(paths, scan_file, index_path, max_workers=16):
+    if index_path not in _loaded:
+        _loaded[index_path] = file_index.load_index(index_path)
+    index = _loaded[index_path]
+    stale = file_index.update_index(index, paths, scan_file, max_workers)
+
+    if stale:
+        try:
+            file_index.save_index(index_path, index)
+        except OSError as e:
+            print(f"Could not save {index_path} ({e}), the index will be rebuilt next run")
+        print(f"Index {index_path}: {len(paths) - len(stale)} files reused, {len(stale)} scanned")
+
+    return {path: index[path] for path in paths}
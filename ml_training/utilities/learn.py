@@ -1,8 +1,8 @@
 import torch
 import onnx
 import onnxruntime as ort
-from torch.utils.data import DataLoader
 import numpy as np
+import utilities.prepare as prepare
 
 def compute_accuracy(outputs, y):
     _, predicted = torch.max(outputs, dim=1)
@@ -37,12 +37,12 @@ def convert_to_onnx(input_dim, model, output_dir, model_name, opset=12):
     onnx.checker.check_model(onnx.load(f"{output_dir}/best_model_{model_name}.onnx"))
     return 0
 
-def onnx_inference(onnx_path, dataset, batch_size=2048):
+def onnx_inference(onnx_path, dataset, batch_size=2048, loader=None):
 
     ort_session = ort.InferenceSession(onnx_path)
     input_name = ort_session.get_inputs()[0].name
     
-    dataloader = DataLoader(dataset, batch_size=batch_size)
+    dataloader = prepare.make_dataloader(dataset, batch_size, loader=loader)
     
     predictions_all = []
     probabilities_all = []
@@ -5,62 +5,253 @@ from sklearn.model_selection import train_test_split
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import default_collate
+from torch.utils.data import get_worker_info
 import h5py
 from torch.utils.data import random_split
+from torch.utils.data import Subset
 import yaml
 import os
+import multiprocessing.util
+import functools
+from collections import OrderedDict
+import json
+import hashlib
+import utilities.utils as utils
+import utilities.h5_index as h5_index
+import shared.shards as shard_format
 
 def load_config(config_path):
     with open(config_path) as f:
         return yaml.safe_load(f)
+
+# "matrix" layout written by root_to_h5: scalar features in one events x features array
+EVENT_MATRIX = "events"
+COLUMNS_ATTR = "columns"
+
+# {feature: column} of the event matrix, None for the one-array-per-branch layout
+def event_matrix_columns(file_h5):
+    if EVENT_MATRIX not in file_h5:
+        return None
+    names = file_h5[EVENT_MATRIX].attrs[COLUMNS_ATTR]
+    return {name.decode() if isinstance(name, bytes) else str(name): i for i, name in enumerate(names)}
+
+# Ragged jagged branches: group with flat values and per-event offsets
+RAGGED_VALUES = "values"
+RAGGED_OFFSETS = "offsets"
+
+def is_ragged(node):
+    return isinstance(node, h5py.Group) and RAGGED_OFFSETS in node
+
+# Objects of one event padded with zeros (or truncated) to max_len
+def read_ragged(group, event_id, max_len):
+    start, stop = group[RAGGED_OFFSETS][event_id:event_id + 2]
+    values = group[RAGGED_VALUES][start:min(stop, start + max_len)]
+    padded = np.zeros(max_len, dtype=values.dtype)
+    padded[:len(values)] = values
+    return padded
+
+# Rows `event_ids` (sorted, unique) of an h5py dataset: a single contiguous read when
+# they are dense enough, one fancy-indexed read otherwise
+CONTIGUOUS_FACTOR = 4
+
+def read_rows(dataset, event_ids):
+    start, stop = int(event_ids[0]), int(event_ids[-1]) + 1
+    if stop - start <= CONTIGUOUS_FACTOR * len(event_ids):
+        return dataset[start:stop][event_ids - start]
+    return dataset[event_ids]
+
+# Batches from __getitems__ come already stacked as (X, y), lists of samples are collated as usual
+def collate_batch(batch):
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+# Index entry of one .h5 file: events, top-level arrays and event matrix columns
+def scan_h5_file(file_path):
+    with h5py.File(file_path, "r") as file_h5:
+        keys = [key for key in file_h5.keys() if key not in shard_format.PROVENANCE]
+        if not keys:
+            return {"entries": 0, "keys": [], "columns": None}
+        node = file_h5[keys[0]]
+        n_events = node[RAGGED_OFFSETS].shape[0] - 1 if is_ragged(node) else node.shape[0]
+        columns = event_matrix_columns(file_h5)
+        return {"entries": int(n_events), "keys": keys, "columns": list(columns) if columns else None}
+
+def file_features(entry, label):
+    arrays = [key for key in entry["keys"] if key not in (label, EVENT_MATRIX)]
+    return (entry["columns"] or []) + arrays
+
+# Index entries of the .h5 files of `dir_paths`, from the index at `index_path` or,
+# by default, from the sidecar h5_index.INDEX_NAME of every directory
+def h5_index_entries(dir_paths, index_path=None):
+    entries = {}
+    for dir_path in dir_paths:
+        file_paths = h5_file_paths(dir_path)
+        if not file_paths:
+            continue
+        path = index_path or os.path.join(os.path.dirname(file_paths[0]), h5_index.INDEX_NAME)
+        entries.update(h5_index.build_index(file_paths, scan_h5_file, path))
+    return entries
+
+# The shards of a directory replace its per-file outputs while they are up to date
+def h5_file_paths(dir_path):
+    shards_dir = shard_format.current_shards_dir(dir_path)
+    if shards_dir is None and os.path.isdir(os.path.join(dir_path, shard_format.SHARDS_DIR)):
+        print(f"Shards of {dir_path} are out of date, reading the per-file outputs (rerun compact_shards.py)")
+    return shard_format.list_h5_files(shards_dir or dir_path)
     
-class h5Dataset(Dataset):
-    def __init__(self, dir_paths, features, label, num_classes, indices=None, transform=None):
+# Event index shared by the datasets: cumulative event counts of the files plus, for
+# subsets, a NumPy array of global event numbers (None means every event in order).
+# Samples are resolved to (file, event) with searchsorted, and the whole index
+# pickles as two arrays.
+class EventIndexDataset(Dataset):
+    def set_index(self, indices=None):
+        self.file_offsets = np.concatenate([[0], np.cumsum(self.file_event_counts, dtype=np.int64)]).astype(np.int64)
+        self.global_ids = None if indices is None else np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.file_offsets[-1]) if self.global_ids is None else len(self.global_ids)
+
+    # Global event numbers of samples `idx` (an int or an index array)
+    def subset_ids(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        return idx if self.global_ids is None else self.global_ids[idx]
+
+    # (file_id, event_id) of samples `idx`, ints for an int and arrays for an array
+    def locate(self, idx):
+        ids = self.subset_ids(idx)
+        file_ids = np.searchsorted(self.file_offsets, ids, side="right") - 1
+        event_ids = ids - self.file_offsets[file_ids]
+        if np.ndim(ids) == 0:
+            return int(file_ids), int(event_ids)
+        return file_ids, event_ids
+
+
+class h5Dataset(EventIndexDataset):
+    # max_len: length ragged branches are padded to, an int or {branch: int}.
+    # preload: read the events of the dataset into memory at construction, up to
+    # preload_memory bytes (see preload()).
+    # index_path: file index shared by all directories, instead of one sidecar per directory.
+    def __init__(self, dir_paths, features, label, num_classes, indices=None, transform=None, max_len=10,
+                 preload=False, preload_memory="8GB", index_path=None):
         
         self.features = features
         self.label = label
         self.num_classes = num_classes
         self.transform = transform
+        self.max_len = max_len
         
         self.file_paths = []
         self.file_event_counts = []
+        self.file_columns = []
         
-        for dir_path in dir_paths:
-            for file_name in sorted(os.listdir(dir_path)):
-                if file_name.endswith(".h5"):
-                    file_path = os.path.join(dir_path, file_name)
-                    self.file_paths.append(file_path)
-                    
-                    # All features must have same number of events
-                    with h5py.File(file_path, "r") as file_h5:
-                        if features == "all" or features == ["all"]:
-                            self.features = [key for key in file_h5.keys() if key != label]
-                        n_events = file_h5[self.features[0]].shape[0]
-                    self.file_event_counts.append(n_events)
+        # All features must have same number of events
+        for file_path, entry in h5_index_entries(dir_paths, index_path).items():
+            if entry["entries"] == 0:
+                print(f"Skipping {file_path}: no events")
+                continue
+            self.file_paths.append(file_path)
+            if features == "all" or features == ["all"]:
+                self.features = file_features(entry, label)
+            self.file_event_counts.append(entry["entries"])
+            columns = entry["columns"]
+            self.file_columns.append({name: i for i, name in enumerate(columns)} if columns else None)
 
         self.num_features = len(self.features)
         self.files = [None] * len(self.file_paths) # Lazy open, one handle per worker
         
-        self.global_ids = []
-        for file_id, n_events in enumerate(self.file_event_counts):
-            for event_id in range(n_events):
-                self.global_ids.append((file_id, event_id))
-                
-        if indices is not None:
-            self.global_ids = indices
-                                    
-    def __len__(self):
-        return len(self.global_ids)
+        self.set_index(indices)
         
-    def __getitem__(self, idx):
-        file_id, event_id = self.global_ids[idx]
+        self.preload_rows = None
+        if preload:
+            self.preload(utils.parse_size(preload_memory))
+
+    # Reads the events of the dataset, file by file, into one float32 matrix of
+    # flattened features (self.X, in self.feature_slices) and one int64 label array,
+    # while they fit in `budget` bytes. preload_rows[idx] is the row of sample idx,
+    # or -1 for the files past the budget, which are still read lazily.
+    def preload(self, budget):
+        ids = np.stack(self.locate(np.arange(len(self), dtype=np.int64)), axis=1)
+        self.preload_rows = np.full(len(ids), -1, dtype=np.int64)
+        if len(ids) == 0:
+            return
         
-        # Lazy open H5 files
+        n_loaded = 0
+        for file_id in np.unique(ids[:, 0]):
+            in_file = np.flatnonzero(ids[:, 0] == file_id)
+            event_ids, inverse = np.unique(ids[in_file, 1], return_inverse=True)
+            
+            if n_loaded == 0:
+                # Feature shapes from one event, then the budget sets the number of rows
+                x, _ = self.read_batch(int(file_id), event_ids[:1])
+                self.feature_slices, start = {}, 0
+                for feature in self.features:
+                    shape = x[feature].shape[1:]
+                    size = int(np.prod(shape, dtype=np.int64))
+                    self.feature_slices[feature] = (start, start + size, shape)
+                    start += size
+                row_bytes = 4 * start + 8
+                n_rows = min(len(np.unique(self.subset_ids(np.arange(len(self))))), budget // row_bytes)
+                self.X = np.empty((n_rows, start), dtype=np.float32)
+                self.y = np.empty(n_rows, dtype=np.int64)
+            
+            # A file that does not fit whole fills the rest of the budget with its first events
+            n_fit = min(len(event_ids), len(self.X) - n_loaded)
+            if n_fit == 0:
+                break
+            x, y = self.read_batch(int(file_id), event_ids[:n_fit])
+            for feature, (a, b, _) in self.feature_slices.items():
+                self.X[n_loaded:n_loaded + n_fit, a:b] = x[feature].reshape(n_fit, -1)
+            self.y[n_loaded:n_loaded + n_fit] = y
+            fits = inverse < n_fit
+            self.preload_rows[in_file[fits]] = n_loaded + inverse[fits]
+            n_loaded += n_fit
+            if n_fit < len(event_ids):
+                break
+        
+        self.X, self.y = self.X[:n_loaded], self.y[:n_loaded]
+        self.close()  # no handles inherited by the DataLoader workers
+        print(f"Preloaded {n_loaded} events ({self.X.nbytes / 1024**2:.0f} MB), "
+              f"{np.count_nonzero(self.preload_rows < 0)} samples read lazily")
+
+    def is_preloaded(self, idx):
+        return self.preload_rows is not None and self.preload_rows[idx] >= 0
+
+    # {feature: view} of preloaded rows
+    def preloaded_features(self, X):
+        return {f: X[..., a:b].reshape(X.shape[:-1] + shape) for f, (a, b, shape) in self.feature_slices.items()}
+        
+    # h5py handles cannot be pickled (spawned workers, Ray), they are reopened lazily
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["files"] = [None] * len(self.file_paths)
+        return state
+
+    # Lazy open H5 files
+    def open_file(self, file_id):
         if self.files[file_id] is None:
             self.files[file_id] = h5py.File(self.file_paths[file_id], "r")
-        file_h5 = self.files[file_id]
+        return self.files[file_id]
+
+    def __getitem__(self, idx):
+        if self.is_preloaded(idx):
+            row = self.preload_rows[idx]
+            x = {f: torch.from_numpy(v) for f, v in self.preloaded_features(self.X[row]).items()}
+            y = torch.tensor(self.y[row])
+            return (self.transform(x) if self.transform else x), y
+        
+        file_id, event_id = self.locate(idx)
+        file_h5 = self.open_file(file_id)
             
-        x = [file_h5[feature][event_id][...] for feature in self.features]
+        columns = self.file_columns[file_id]
+        if columns is None:
+            x = [self.read_array(file_h5, feature, event_id) for feature in self.features]
+        else:
+            # One read for all the scalar features of the event
+            row = file_h5[EVENT_MATRIX][event_id]
+            x = [row[columns[feature]] if feature in columns else self.read_array(file_h5, feature, event_id)
+                 for feature in self.features]
         x = {f: torch.tensor(x[i], dtype=torch.float32) for i, f in enumerate(self.features)}
         
         y = torch.tensor(file_h5[self.label][event_id], dtype=torch.long)
@@ -69,27 +260,423 @@ class h5Dataset(Dataset):
             x = self.transform(x)
             
         return x, y
+
+    def read_array(self, file_h5, feature, event_id):
+        node = file_h5[feature]
+        if is_ragged(node):
+            max_len = self.max_len.get(feature, 10) if isinstance(self.max_len, dict) else self.max_len
+            return read_ragged(node, event_id, max_len)
+        return node[event_id][...]
+
+    # {feature: rows} and labels of the sorted, unique `event_ids` of one file
+    def read_batch(self, file_id, event_ids):
+        file_h5 = self.open_file(file_id)
+        columns = self.file_columns[file_id] or {}
+        matrix = None
+        if any(feature in columns for feature in self.features):
+            matrix = read_rows(file_h5[EVENT_MATRIX], event_ids)
+        
+        x = {}
+        for feature in self.features:
+            if feature in columns:
+                x[feature] = matrix[:, columns[feature]]
+            elif is_ragged(file_h5[feature]):
+                x[feature] = np.stack([self.read_array(file_h5, feature, e) for e in event_ids])
+            else:
+                x[feature] = read_rows(file_h5[feature], event_ids)
+        return x, read_rows(file_h5[self.label], event_ids)
+
+    # Batched path of the DataLoader: indices grouped by file and sorted, one read per
+    # feature and file, returned as stacked (X, y). Needs a transform with a batch
+    # version (or none), otherwise falls back to one sample at a time.
+    def __getitems__(self, indices):
+        if self.transform is not None and not hasattr(self.transform, "batch"):
+            return [self[i] for i in indices]
+        
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = self.preload_rows[indices] if self.preload_rows is not None else np.full(len(indices), -1)
+        loaded = rows >= 0
+        if loaded.all():
+            x, y = self.preloaded_features(self.X[rows]), self.y[rows]
+        elif not loaded.any():
+            x, y = self.read_lazy(indices)
+        else:
+            x = {f: np.empty((len(indices),) + shape, dtype=np.float32) for f, (_, _, shape) in self.feature_slices.items()}
+            y = np.empty(len(indices), dtype=np.int64)
+            for f, value in self.preloaded_features(self.X[rows[loaded]]).items():
+                x[f][loaded] = value
+            y[loaded] = self.y[rows[loaded]]
+            lazy_x, y[~loaded] = self.read_lazy(indices[~loaded])
+            for f, value in lazy_x.items():
+                x[f][~loaded] = value
+        
+        x = {f: torch.from_numpy(np.ascontiguousarray(value)) for f, value in x.items()}
+        y = torch.from_numpy(y)
+        if self.transform:
+            x = self.transform.batch(x)
+            
+        return x, y
+
+    # {feature: float32 rows} and int64 labels of `indices`, read from the files
+    def read_lazy(self, indices):
+        ids = np.stack(self.locate(np.asarray(indices, dtype=np.int64)), axis=1)
+        
+        positions, x_parts, y_parts = [], {f: [] for f in self.features}, []
+        for file_id in np.unique(ids[:, 0]):
+            in_file = np.flatnonzero(ids[:, 0] == file_id)
+            event_ids, inverse = np.unique(ids[in_file, 1], return_inverse=True)
+            x, y = self.read_batch(int(file_id), event_ids)
+            positions.append(in_file)
+            for feature in self.features:
+                x_parts[feature].append(x[feature][inverse])
+            y_parts.append(y[inverse])
+        
+        # Back to the order of `indices`
+        order = np.argsort(np.concatenate(positions), kind="stable")
+        x = {f: np.concatenate(parts)[order].astype(np.float32) for f, parts in x_parts.items()}
+        return x, np.concatenate(y_parts)[order].astype(np.int64)
                 
     def close(self):
         for file in self.files:
             if file:
                 file.close()
+        self.files = [None] * len(self.file_paths)
+
+
+# Local cache of decoded chunks, shared by all workers and runs: one .npz per
+# (file, cluster range, columns). Least recently used files are removed once the
+# directory is over max_bytes.
+class ChunkCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def put(self, key, arrays):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz") and ".tmp" not in name:
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# Index entry of one ROOT file: events, branches and cluster boundaries of `tree_name`
+def scan_root_file(file_path, tree_name):
+    import uproot
+    with uproot.open(file_path) as upfile:
+        tree = upfile[tree_name]
+        return {"entries": int(tree.num_entries), "keys": list(tree.keys()),
+                "clusters": [int(x) for x in tree.common_entry_offsets()]}
+
+# Same as h5_index_entries for the .root files, with one sidecar per tree name
+def root_index_entries(dir_paths, tree_name):
+    entries = {}
+    for dir_path in dir_paths:
+        file_paths = [os.path.join(dir_path, f) for f in sorted(os.listdir(dir_path)) if f.endswith(".root")]
+        if not file_paths:
+            continue
+        path = os.path.join(dir_path, f".{tree_name}{h5_index.INDEX_NAME}")
+        entries.update(h5_index.build_index(file_paths, functools.partial(scan_root_file, tree_name=tree_name), path))
+    return entries
+
+# Reads the features and label straight from the processed ROOT files, one
+# cluster-aligned chunk at a time, with the same interface as h5Dataset.
+# Decoded chunks are kept in memory (the memory_chunks most recently used) and
+# in a ChunkCache on disk.
+class rootDataset(EventIndexDataset):
+    def __init__(self, dir_paths, features, label, num_classes, indices=None, transform=None, max_len=10,
+                 tree_name="Events", cache_dir=None, cache_size="10GB", memory_chunks=8):
+        
+        self.features = features
+        self.label = label
+        self.num_classes = num_classes
+        self.transform = transform
+        self.max_len = max_len
+        self.tree_name = tree_name
+        self.cache = ChunkCache(cache_dir, utils.parse_size(cache_size)) if cache_dir else None
+        self.memory_chunks = memory_chunks
+        
+        self.file_paths = []
+        self.file_event_counts = []
+        self.file_clusters = []
+        
+        for file_path, entry in root_index_entries(dir_paths, tree_name).items():
+            if entry["entries"] == 0:
+                continue
+            if features == "all" or features == ["all"]:
+                self.features = [key for key in entry["keys"] if key != label]
+            self.file_paths.append(file_path)
+            self.file_event_counts.append(entry["entries"])
+            self.file_clusters.append(np.asarray(entry["clusters"], dtype=np.int64))
+
+        self.num_features = len(self.features)
+        self.file_keys = {}
+        self.chunks = OrderedDict()  # (file_id, start) -> chunk, most recently used last
+        
+        self.set_index(indices)
+
+    def feature_max_len(self, feature):
+        return self.max_len.get(feature, 10) if isinstance(self.max_len, dict) else self.max_len
+
+    # Decoded chunks are not shipped to spawned workers or Ray trials, each copy refills its own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["chunks"] = OrderedDict()
+        state["file_keys"] = {}
+        return state
+
+    # The file part of the key is computed once per file
+    def cache_key(self, file_id, start, stop):
+        if file_id not in self.file_keys:
+            path = self.file_paths[file_id]
+            st = os.stat(path)
+            digest = hashlib.sha256(repr((os.path.abspath(path), st.st_size, st.st_mtime, self.tree_name,
+                                          self.features, self.label, self.max_len)).encode())
+            self.file_keys[file_id] = digest.hexdigest()[:16]
+        return f"{self.file_keys[file_id]}_{start}_{stop}"
+
+    def read_chunk(self, file_id, start, stop):
+        import uproot
+        import awkward as ak
+        with uproot.open(self.file_paths[file_id]) as upfile:
+            arrays = upfile[self.tree_name].arrays(self.features + [self.label], entry_start=start,
+                                                   entry_stop=stop, library="ak")
+        chunk = {}
+        for name in self.features + [self.label]:
+            array = arrays[name]
+            if isinstance(array.layout, ak.contents.ListOffsetArray):
+                array = ak.fill_none(ak.pad_none(array, self.feature_max_len(name), clip=True), 0)
+            chunk[name] = ak.to_numpy(array)
+        return chunk
+
+    # Decoded columns of the cluster range holding `event_id`, and its first entry
+    def load_chunk(self, file_id, event_id):
+        clusters = self.file_clusters[file_id]
+        i = int(np.searchsorted(clusters, event_id, side="right"))
+        start, stop = int(clusters[i - 1]), int(clusters[i])
+        chunk = self.chunks.get((file_id, start))
+        if chunk is not None:
+            self.chunks.move_to_end((file_id, start))
+            return chunk, start
+        
+        key = self.cache_key(file_id, start, stop) if self.cache else None
+        chunk = self.cache.get(key) if self.cache else None
+        if chunk is None:
+            chunk = self.read_chunk(file_id, start, stop)
+            if self.cache:
+                self.cache.put(key, chunk)
+        self.chunks[(file_id, start)] = chunk
+        if len(self.chunks) > self.memory_chunks:
+            self.chunks.popitem(last=False)
+        return chunk, start
+
+    def __getitem__(self, idx):
+        file_id, event_id = self.locate(idx)
+        chunk, start = self.load_chunk(file_id, event_id)
+        row = event_id - start
+
+        x = {f: torch.tensor(chunk[f][row], dtype=torch.float32) for f in self.features}
+        y = torch.tensor(chunk[self.label][row], dtype=torch.long)
+        
+        if self.transform:
+            x = self.transform(x)
+            
+        return x, y
+
+    # Batched path of the DataLoader: indices grouped by file and cluster, so every
+    # chunk is loaded once per batch, returned as stacked (X, y) like h5Dataset
+    def __getitems__(self, indices):
+        if self.transform is not None and not hasattr(self.transform, "batch"):
+            return [self[i] for i in indices]
+        
+        file_ids, event_ids = self.locate(np.asarray(indices, dtype=np.int64))
+        positions, x_parts, y_parts = [], {f: [] for f in self.features}, []
+        for file_id in np.unique(file_ids):
+            in_file = np.flatnonzero(file_ids == file_id)
+            cluster_ids = np.searchsorted(self.file_clusters[file_id], event_ids[in_file], side="right")
+            for cluster_id in np.unique(cluster_ids):
+                in_chunk = in_file[cluster_ids == cluster_id]
+                chunk, start = self.load_chunk(int(file_id), int(event_ids[in_chunk[0]]))
+                rows = event_ids[in_chunk] - start
+                positions.append(in_chunk)
+                for feature in self.features:
+                    x_parts[feature].append(chunk[feature][rows])
+                y_parts.append(chunk[self.label][rows])
+        
+        # Back to the order of `indices`
+        order = np.argsort(np.concatenate(positions), kind="stable")
+        x = {f: torch.from_numpy(np.concatenate(parts)[order].astype(np.float32)) for f, parts in x_parts.items()}
+        y = torch.from_numpy(np.concatenate(y_parts)[order].astype(np.int64))
+        if self.transform:
+            x = self.transform.batch(x)
+            
+        return x, y
+
+    def close(self):
+        self.chunks = OrderedDict()
+
+
+# Directories written by root_to_npy: one .npy per array plus a manifest.json
+NPY_SUFFIX = ".npy.d"
+NPY_MANIFEST = "manifest.json"
+
+def read_npy_manifest(dir_path):
+    with open(os.path.join(dir_path, NPY_MANIFEST)) as f:
+        return json.load(f)
+
+# Memory-maps the .npy outputs, so reading an event is a view of the page cache
+# that torch.from_numpy wraps without a copy. Maps are opened lazily, one set per
+# worker, and never pickled.
+class npyDataset(EventIndexDataset):
+    def __init__(self, dir_paths, features, label, num_classes, indices=None, transform=None, **unused):
+        
+        self.features = features
+        self.label = label
+        self.num_classes = num_classes
+        self.transform = transform
+        
+        self.file_paths = []
+        self.file_event_counts = []
+        self.file_columns = []
+        
+        for dir_path in dir_paths:
+            for name in sorted(os.listdir(dir_path)):
+                if not name.endswith(NPY_SUFFIX):
+                    continue
+                file_path = os.path.join(dir_path, name)
+                manifest = read_npy_manifest(file_path)
+                columns = {c: i for i, c in enumerate(manifest.get(COLUMNS_ATTR, []))}
+                if features == "all" or features == ["all"]:
+                    arrays = [a for a in manifest["arrays"] if a not in (label, EVENT_MATRIX)]
+                    self.features = list(columns) + arrays
+                self.file_paths.append(file_path)
+                self.file_event_counts.append(manifest["n_events"])
+                self.file_columns.append(columns or None)
+
+        self.num_features = len(self.features)
+        self.files = [None] * len(self.file_paths)
+        
+        self.set_index(indices)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["files"] = [None] * len(self.file_paths)
+        return state
+
+    # "c" (copy-on-write) gives writable views, which torch.from_numpy needs, without touching the files
+    def open_file(self, file_id):
+        if self.files[file_id] is None:
+            file_path = self.file_paths[file_id]
+            manifest = read_npy_manifest(file_path)
+            self.files[file_id] = {name: np.load(os.path.join(file_path, info["file"]), mmap_mode="c")
+                                   for name, info in manifest["arrays"].items()}
+        return self.files[file_id]
+
+    def __getitem__(self, idx):
+        file_id, event_id = self.locate(idx)
+        arrays = self.open_file(file_id)
+        columns = self.file_columns[file_id]
+        
+        # Slices keep ndarray views (an integer index of a 1-D array gives a numpy scalar)
+        if columns is not None:
+            row = torch.from_numpy(arrays[EVENT_MATRIX][event_id:event_id + 1])[0]
+        x = {f: row[columns[f]] if columns is not None and f in columns
+             else torch.from_numpy(arrays[f][event_id:event_id + 1])[0]
+             for f in self.features}
+        x = {f: value if value.dtype == torch.float32 else value.float() for f, value in x.items()}
+        y = torch.as_tensor(arrays[self.label][event_id]).long()
+        
+        if self.transform:
+            x = self.transform(x)
+            
+        return x, y
+
+    def close(self):
+        self.files = [None] * len(self.file_paths)
+
+
+# DataLoader settings, overridden by the data.loader section of the config
+LOADER_DEFAULTS = {
+    "num_workers": 0,
+    "prefetch_factor": 2,
+    "persistent_workers": False,
+    "pin_memory": False,
+}
+
+# Dataset under the Subsets of random_split
+def base_dataset(dataset):
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return dataset
+
+# Every worker opens its own file handles: the ones inherited through fork are
+# dropped, and the ones it opens are closed when it exits
+def worker_init(worker_id):
+    dataset = base_dataset(get_worker_info().dataset)
+    dataset.close()
+    multiprocessing.util.Finalize(dataset, dataset.close, exitpriority=10)
+
+def make_dataloader(dataset, batch_size, shuffle=False, loader=None):
+    options = {**LOADER_DEFAULTS, **(loader or {})}
+    num_workers = int(options["num_workers"])
+    worker_options = {}
+    if num_workers > 0:
+        base_dataset(dataset).close() # no handles of the main process in the workers
+        worker_options = dict(
+            prefetch_factor=int(options["prefetch_factor"]),
+            persistent_workers=bool(options["persistent_workers"]),
+            worker_init_fn=worker_init,
+        )
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_batch,
+                      num_workers=num_workers, pin_memory=bool(options["pin_memory"]) and torch.cuda.is_available(),
+                      **worker_options)
 
 
-def split_and_transform_pythorch(h5_dataset, test_size, batch_size, train_suffle=True):
+def split_and_transform_pythorch(h5_dataset, test_size, batch_size, train_suffle=True, loader=None):
 
     test_len = int(test_size * len(h5_dataset))
     train_len  = len(h5_dataset) - test_len
     train_set, test_set = random_split(h5_dataset, [train_len, test_len])
     
-    train_dataloader = DataLoader(train_set, batch_size=batch_size, shuffle=train_suffle)
-    test_dataloader = DataLoader(test_set, batch_size=batch_size)
+    train_dataloader = make_dataloader(train_set, batch_size, shuffle=train_suffle, loader=loader)
+    test_dataloader = make_dataloader(test_set, batch_size, loader=loader)
     
     return train_dataloader, test_dataloader
 
 
 def split_h5Dataset(dataset, test_size, seed):
-    all_indices = list(range(len(dataset)))
+    all_indices = np.arange(len(dataset), dtype=np.int64)
 
     train_idx, test_idx = train_test_split(
             all_indices,
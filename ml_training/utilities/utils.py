@@ -1,5 +1,8 @@
 import datetime
 import json
+import shared.utils as shared_utils
+
+parse_size = shared_utils.parse_size
 
 def read_json(path):
     with open(path, "r") as f:
@@ -0,0 +1,50 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Indexes of file metadata keyed by path: the ROOT catalogue of data_processing and
+# the dataset index of ml_training. An entry is valid as long as the size and mtime
+# of its file do not change. Remote (xrootd) files are CMS LFNs, which never change,
+# so they are keyed by path only.
+
+def is_remote(path):
+    return "://" in path
+
+def file_fingerprint(path):
+    if is_remote(path):
+        return {"size": None, "mtime": None}
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def is_current(entry, path):
+    if entry is None:
+        return False
+    return all(entry.get(k) == v for k, v in file_fingerprint(path).items())
+
+# A missing or unreadable index is rebuilt from scratch
+def load_index(index_path):
+    if not index_path or not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable index {index_path} ({e})")
+        return {}
+
+def save_index(index_path, index):
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+# Scan the new or changed files of `paths` into `index` with `scan_file`, in parallel,
+# and return the scanned paths
+def update_index(index, paths, scan_file, max_workers=8):
+    stale = [path for path in paths if not is_current(index.get(path), path)]
+    if stale:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for path, meta in zip(stale, pool.map(scan_file, stale)):
+                index[path] = {**file_fingerprint(path), **meta}
+    return stale
@@ -0,0 +1,43 @@
+import os
+import json
+
+# Shards written by data_processing/convert_h5/compact_shards.py into "<exp_dir>/shards"
+# and read by ml_training. Every shard keeps, per row, the index of its source file
+# (SOURCE_FILE, names in SOURCE_FILES) and the row it had there (SOURCE_ENTRY).
+# MANIFEST_NAME records the size and mtime of the per-file outputs the shards were
+# made from, so outputs converted or appended to afterwards make the shards stale.
+
+SHARDS_DIR = "shards"
+SOURCE_FILES = "source_files"
+SOURCE_FILE = "source_file"
+SOURCE_ENTRY = "source_entry"
+PROVENANCE = (SOURCE_FILES, SOURCE_FILE, SOURCE_ENTRY)
+MANIFEST_NAME = "manifest.json"
+
+def list_h5_files(dir_path):
+    return [os.path.join(dir_path, f) for f in sorted(os.listdir(dir_path)) if f.endswith(".h5")]
+
+def source_state(paths):
+    state = {}
+    for path in paths:
+        st = os.stat(path)
+        state[os.path.basename(path)] = {"size": st.st_size, "mtime": st.st_mtime}
+    return state
+
+def write_manifest(shards_dir, source_paths):
+    with open(os.path.join(shards_dir, MANIFEST_NAME), "w") as f:
+        json.dump({"sources": source_state(source_paths)}, f)
+
+# "<exp_dir>/shards" if it holds every per-file output of exp_dir as it is now, None
+# otherwise. Per-file outputs removed after the compaction do not make it stale.
+def current_shards_dir(exp_dir):
+    shards_dir = os.path.join(exp_dir, SHARDS_DIR)
+    manifest_path = os.path.join(shards_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        sources = json.load(f)["sources"]
+    for name, state in source_state(list_h5_files(exp_dir)).items():
+        if sources.get(name) != state:
+            return None
+    return shards_dir
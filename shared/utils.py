@@ -0,0 +1,10 @@
+# Sizes from the yaml configs: a number of bytes or a string such as "8GB", "512MB"
+def parse_size(size):
+    if size is None or isinstance(size, (int, float)):
+        return size
+    units = {"KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4, "B": 1}
+    size = str(size).strip().upper()
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(float(size))